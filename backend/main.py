@@ -1,14 +1,37 @@
 import os
-from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi import FastAPI, HTTPException, Request, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import requests
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import json
 from typing import List, Dict, Any, Optional
 import httpx
+import asyncio
+import base64
+import bisect
+import csv
+import hashlib
+import heapq
+import io
+import math
+import mmap
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from supabase import create_client, Client
 import re
 try:
@@ -24,16 +47,201 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY")
 
+# Directory for local durable state (scheduled calls, etc.)
+DATA_DIR = os.getenv("CALLMATE_DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+
+# --- Admission control ---
+# Bounds concurrent work so overload turns into fast 429/503s instead of everyone's
+# latency collapsing. Requests are admitted by priority lane; the upstream limits
+# below cap how many requests each external service sees at once.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "32"))
+UPSTREAM_LIMITS = {"bland": 16, "gemini": 8, "supabase": 16, "textbelt": 2}
+UPSTREAM_WAIT = 5  # seconds to wait for an upstream slot before giving up
+
+LANE_ADMIN, LANE_CALLS, LANE_INTERACTIVE, LANE_POLLING = range(4)
+# Per lane: (max queued requests, seconds a queued request may wait)
+LANE_QUEUES = {
+    LANE_ADMIN: (50, 10.0),
+    LANE_CALLS: (200, 10.0),
+    LANE_INTERACTIVE: (200, 5.0),
+    LANE_POLLING: (100, 2.0),
+}
+CALL_PLACEMENT_PATHS = {"/api/call", "/api/scheduled_calls", "/api/sms", "/api/sms/bulk"}
+POLLING_PATH_RE = re.compile(r"^/api/(history|call_transcript|call_corrected_transcript|call_details|call_recording|chat_history|sms|sms_history|export)(/|$)")
+
+class UpstreamBusy(HTTPException):
+    """An upstream service is at its concurrency limit"""
+    
+    def __init__(self, upstream: str):
+        super().__init__(status_code=503, detail=f"{upstream} is busy, please retry shortly", headers={"Retry-After": "2"})
+
+upstream_semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in UPSTREAM_LIMITS.items()}
+
+@contextmanager
+def upstream_slot(upstream: str):
+    """Hold one of an upstream's concurrency slots for the duration of a request"""
+    semaphore = upstream_semaphores[upstream]
+    if not semaphore.acquire(timeout=UPSTREAM_WAIT):
+        raise UpstreamBusy(upstream)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+class UpstreamLimitedQuery:
+    """Wraps a Supabase query builder so execute() runs inside a supabase slot"""
+    
+    def __init__(self, query):
+        self._query = query
+    
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if name == "execute":
+            def execute(*args, **kwargs):
+                with upstream_slot("supabase"):
+                    return attr(*args, **kwargs)
+            return execute
+        if callable(attr):
+            def chain(*args, **kwargs):
+                result = attr(*args, **kwargs)
+                return UpstreamLimitedQuery(result) if hasattr(result, "execute") else result
+            return chain
+        return attr
+
+class UpstreamLimitedClient:
+    """Supabase client whose table queries count against the supabase upstream limit"""
+    
+    def __init__(self, client: Client):
+        self._client = client
+    
+    def table(self, name: str):
+        return UpstreamLimitedQuery(self._client.table(name))
+    
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+class AdmissionController:
+    """Caps in-flight requests; queued requests are admitted lowest lane first"""
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.queues: Dict[int, deque] = {lane: deque() for lane in LANE_QUEUES}
+    
+    async def acquire(self, lane: int) -> Optional[Response]:
+        """Admit the request, or return the 429/503 to send instead"""
+        if self.in_flight < self.limit and not any(self.queues[l] for l in self.queues if l <= lane):
+            self.in_flight += 1
+            return None
+        
+        max_queued, deadline = LANE_QUEUES[lane]
+        queue = self.queues[lane]
+        if len(queue) >= max_queued:
+            return overload_response(429, "Too many requests, please retry shortly", 1)
+        
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), deadline)
+            return None
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Admitted just as the deadline passed - take the slot
+                return None
+            return overload_response(503, "Server is busy, please retry shortly", 2)
+        except asyncio.CancelledError:
+            # Client went away; pass on a slot that was handed to us
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            if waiter in queue:
+                queue.remove(waiter)
+    
+    def release(self):
+        # Hand the slot straight to the highest-priority waiter, if any
+        for lane in sorted(self.queues):
+            queue = self.queues[lane]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(True)
+                    return
+        self.in_flight -= 1
+
+def overload_response(status_code: int, detail: str, retry_after: int) -> Response:
+    return Response(
+        content=json.dumps({"detail": detail}),
+        status_code=status_code,
+        media_type="application/json",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+class AdmissionControl:
+    """ASGI middleware that admits /api requests through an AdmissionController"""
+    
+    def __init__(self, app, limit: int = MAX_CONCURRENT_REQUESTS):
+        self.app = app
+        self.controller = AdmissionController(limit)
+    
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not path.startswith("/api/") or path.startswith("/api/webhooks/"):
+            await self.app(scope, receive, send)
+            return
+        
+        lane, receive = await self.classify(scope, receive)
+        rejection = await self.controller.acquire(lane)
+        if rejection:
+            await rejection(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+    
+    async def classify(self, scope, receive):
+        """Pick the request's lane; call placement bodies are read to spot admin requests"""
+        path = scope["path"]
+        method = scope["method"]
+        if method == "POST" and path in CALL_PLACEMENT_PATHS:
+            body = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            
+            replayed = False
+            async def replay():
+                nonlocal replayed
+                if not replayed:
+                    replayed = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+            
+            try:
+                is_admin = json.loads(body).get("admin") is True
+            except (ValueError, AttributeError):
+                is_admin = False
+            return (LANE_ADMIN if is_admin else LANE_CALLS), replay
+        if method == "GET" and POLLING_PATH_RE.match(path):
+            return LANE_POLLING, receive
+        return LANE_INTERACTIVE, receive
+
 # Initialize Supabase client
 supabase: Client = None
 if SUPABASE_URL and SUPABASE_KEY:
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        supabase = UpstreamLimitedClient(create_client(SUPABASE_URL, SUPABASE_KEY))
         print("Supabase client initialized successfully")
     except Exception as e:
         print(f"Error initializing Supabase client: {str(e)}")
 
 app = FastAPI()
+app.add_middleware(AdmissionControl)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -42,6 +250,138 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def open_local_db(filename: str) -> sqlite3.Connection:
+    """Open a SQLite database in DATA_DIR, shared between threads"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(DATA_DIR, filename), check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    return conn
+
+class DurableQueue:
+    """Jobs kept in a SQLite table and dispatched in due-time order by one thread.
+    
+    Ready jobs are also kept in a min-heap of (due time, job id), so the
+    dispatcher sleeps until exactly the next job is due instead of polling.
+    Heap entries are never removed in place: an entry is skipped when its job
+    is no longer in ready_status or has been rescheduled later, and jobs
+    handed to a worker are tracked in in_flight until process() requeues or
+    releases them. With workers=0 jobs run on the dispatcher thread itself.
+    
+    Subclasses set table/id_column/due_column/ready_status and implement
+    create_tables() and process(); recover() runs once at startup before the
+    heap is loaded.
+    """
+    
+    table = ""
+    id_column = "id"
+    due_column = "due_at"
+    ready_status = "pending"
+    wait_on_stop = False  # let running jobs finish on shutdown
+    
+    def __init__(self, filename: str, name: str, workers: int = 0):
+        self.filename = filename
+        self.name = name
+        self.workers = workers
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.heap: List[tuple] = []
+        self.in_flight: set = set()
+        self.thread: Optional[threading.Thread] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.running = False
+    
+    def create_tables(self):
+        raise NotImplementedError
+    
+    def recover(self):
+        """Called with self.lock held before ready jobs are loaded"""
+    
+    def process(self, job_id: str):
+        raise NotImplementedError
+    
+    def start(self):
+        self.conn = open_local_db(self.filename)
+        self.create_tables()
+        
+        with self.lock:
+            self.recover()
+            rows = self.conn.execute(
+                f"SELECT {self.due_column}, {self.id_column} FROM {self.table} WHERE status = ?",
+                (self.ready_status,)
+            ).fetchall()
+            self.heap = [(due_at, job_id) for due_at, job_id in rows]
+            heapq.heapify(self.heap)
+            self.running = True
+        
+        if self.workers:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        with self.wakeup:
+            self.running = False
+            self.wakeup.notify()
+        if self.executor:
+            # Jobs still waiting for a worker stay ready in SQLite and run after the restart
+            self.executor.shutdown(wait=self.wait_on_stop, cancel_futures=True)
+    
+    def _push(self, job_id: str, due_at: float):
+        # Caller holds self.lock; only wake the dispatcher if this job is now the earliest one
+        heapq.heappush(self.heap, (due_at, job_id))
+        if self.heap[0][1] == job_id:
+            self.wakeup.notify()
+    
+    def _requeue(self, job_id: str, due_at: float):
+        # Caller holds self.lock and has already stored the job's new due time
+        self.in_flight.discard(job_id)
+        self._push(job_id, due_at)
+    
+    def ready_at(self) -> Optional[float]:
+        """When the dispatcher may next take a job; caller holds self.lock"""
+        return self.heap[0][0] if self.heap else None
+    
+    def pace(self) -> bool:
+        """Called before a due job is taken; return False to look again (e.g. after a rate-limit sleep)"""
+        return True
+    
+    def _run(self):
+        while True:
+            with self.wakeup:
+                while self.running:
+                    now = time.time()
+                    ready_at = self.ready_at()
+                    if ready_at is not None and ready_at <= now:
+                        break
+                    self.wakeup.wait(ready_at - now if ready_at is not None else None)
+                if not self.running:
+                    return
+            
+            if not self.pace():
+                continue
+            
+            with self.lock:
+                due_at, job_id = heapq.heappop(self.heap)
+                row = self.conn.execute(
+                    f"SELECT {self.due_column} FROM {self.table} WHERE {self.id_column} = ? AND status = ?",
+                    (job_id, self.ready_status)
+                ).fetchone()
+                # Skip finished or cancelled jobs, entries superseded by a reschedule, and jobs already handed out
+                if not row or row[0] > due_at or job_id in self.in_flight:
+                    continue
+                self.in_flight.add(job_id)
+            
+            if not self.executor:
+                self.process(job_id)
+                continue
+            try:
+                self.executor.submit(self.process, job_id)
+            except RuntimeError:
+                # Shutting down - the job is still ready in SQLite and runs after the restart
+                return
+
 # Dependency for authenticated user ID through headers
 def get_current_user_id(user_id: str = Header(None)):
     return user_id
@@ -74,9 +414,22 @@ class SMSRequest(BaseModel):
     admin: Optional[bool] = False
     user_id: Optional[str] = None
 
+class ChatMessageRequest(BaseModel):
+    user_id: Optional[str] = None
+    message: Optional[str] = None
+
 class NameVerificationRequest(BaseModel):
     name: str
 
+class BulkNameVerificationRequest(BaseModel):
+    names: List[str]
+
+class ScheduledCallRequest(CallRequest):
+    # ISO 8601 time, e.g. "2025-06-01T09:00:00" or "2025-06-01T09:00:00-04:00"
+    scheduled_time: str
+    # IANA timezone used when scheduled_time has no offset, e.g. "America/New_York"
+    timezone: Optional[str] = None
+
 # Gemini moderation function
 def moderate_call(topic: str, phone_number: str = None) -> dict:
     """Moderate call content using Gemini API and check for emergency numbers"""
@@ -108,7 +461,8 @@ def moderate_call(topic: str, phone_number: str = None) -> dict:
                 {"role": "user", "parts": [{"text": prompt}]}
             ]
         }
-        response = requests.post(url, headers=headers, json=data)
+        with upstream_slot("gemini"):
+            response = requests.post(url, headers=headers, json=data)
         if response.status_code != 200:
             return {"allowed": True, "reason": "Moderation service unavailable"}
         result = response.json()
@@ -122,16 +476,156 @@ def moderate_call(topic: str, phone_number: str = None) -> dict:
             except Exception:
                 pass
         return {"allowed": True, "reason": "Could not parse moderation response"}
+    except UpstreamBusy:
+        raise
     except Exception as e:
         return {"allowed": True, "reason": f"Moderation error: {str(e)}"}
 
+# --- Conditional requests (ETag / If-None-Match) ---
+# Versions are per process: BOOT_ID keeps ETags from before a restart from matching
+BOOT_ID = uuid.uuid4().hex[:8]
+HISTORY_MAX_AGE = 5  # seconds
+COMPLETED_MAX_AGE = 86400  # seconds
+COMPLETED_ETAG_CACHE_SIZE = 10000
+
+resource_versions: Dict[str, int] = {}
+completed_call_etags: "OrderedDict[str, str]" = OrderedDict()
+
+CONDITIONAL_ROUTES = [
+    (re.compile(r"^/api/history(?:/[^/]+)?$"), "history"),
+    (re.compile(r"^/api/chat_history/([^/]+)$"), "chat"),
+    (re.compile(r"^/api/call_details/([^/]+)$"), "call_details"),
+    (re.compile(r"^/api/call(?:_corrected)?_transcript/([^/]+)$"), "transcript"),
+]
+
+def bump_version(key: str):
+    """Invalidate ETags for a resource after the backend changes it"""
+    resource_versions[key] = resource_versions.get(key, 0) + 1
+
+def make_etag(*parts) -> str:
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    if not if_none_match or not etag:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in candidates)
+
+def known_etag(kind: str, key: str, request: Request):
+    """ETag and Cache-Control for a resource that can be decided without running the handler"""
+    if kind == "chat":
+        # Until the user's Supabase history has been copied in, the handler must run to try again
+        if supabase and key not in chat_log.hydrated:
+            return None, None
+        return make_etag(BOOT_ID, resource_versions.get(f"chat:{key}", 0)), "private, no-cache"
+    if kind == "call_details" and key in completed_call_etags:
+        return completed_call_etags[key], f"private, max-age={COMPLETED_MAX_AGE}"
+    if kind == "transcript":
+        state = cached_transcript(key)
+        # Live transcripts must reach the handler so it can pull new segments from Bland.ai
+        if state and state.final:
+            return transcript_etag(state, request), f"private, max-age={COMPLETED_MAX_AGE}"
+    return None, None
+
+def transcript_etag(state: "TranscriptState", request: Request) -> str:
+    cursor = request.query_params.get("cursor", "")
+    return make_etag(state.generation, len(state.segments), int(state.final), cursor)
+
+def response_etag(kind: str, key: str, request: Request, body: bytes, etag: Optional[str], cache_control: Optional[str]):
+    """ETag and Cache-Control once the handler has produced the body"""
+    if kind == "transcript":
+        state = cached_transcript(key)
+        if state:
+            return transcript_etag(state, request), f"private, max-age={COMPLETED_MAX_AGE}" if state.final else "private, no-cache"
+    
+    if kind == "chat" and not etag:
+        # The handler may just have finished hydrating the user
+        etag, cache_control = known_etag(kind, key, request)
+    if etag:
+        return etag, cache_control
+    
+    etag = make_etag(hashlib.blake2b(body, digest_size=12).hexdigest())
+    if kind == "history":
+        # Clients also write call_history directly, so only the body itself says whether it changed
+        return etag, f"private, max-age={HISTORY_MAX_AGE}"
+    if kind == "call_details":
+        try:
+            details = json.loads(body)
+        except ValueError:
+            details = {}
+        if call_is_complete(details):
+            # A finished call's details no longer change - answer revalidations without asking Bland.ai
+            completed_call_etags[key] = etag
+            while len(completed_call_etags) > COMPLETED_ETAG_CACHE_SIZE:
+                completed_call_etags.popitem(last=False)
+            return etag, f"private, max-age={COMPLETED_MAX_AGE}"
+    return etag, "private, no-cache"
+
+def not_modified(etag: str, cache_control: Optional[str]) -> Response:
+    headers = {"ETag": etag}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    return Response(status_code=304, headers=headers)
+
+async def conditional_requests(request: Request, call_next):
+    """Add ETag / Cache-Control to read endpoints and answer If-None-Match with 304"""
+    route = None
+    if request.method == "GET":
+        for pattern, kind in CONDITIONAL_ROUTES:
+            match = pattern.match(request.url.path)
+            if match:
+                route = (kind, match.group(1) if match.groups() else None)
+                break
+    if not route:
+        return await call_next(request)
+    
+    kind, key = route
+    if_none_match = request.headers.get("if-none-match")
+    etag, cache_control = known_etag(kind, key, request)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, cache_control)
+    
+    response = await call_next(request)
+    if response.status_code != 200:
+        return response
+    
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag, cache_control = response_etag(kind, key, request, body, etag, cache_control)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag, cache_control)
+    
+    headers = dict(response.headers)
+    headers["ETag"] = etag
+    headers["Cache-Control"] = cache_control
+    return Response(content=body, status_code=response.status_code, headers=headers, media_type=response.media_type)
+
+class ConditionalRequests:
+    """Runs conditional_requests only on the routes it applies to.
+    
+    BaseHTTPMiddleware ends a streamed body cleanly even when the handler's
+    generator fails, so every other response (e.g. /api/export) bypasses it
+    and an error mid-stream still aborts the connection.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self.conditional = BaseHTTPMiddleware(app, dispatch=conditional_requests)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "GET" and any(pattern.match(scope["path"]) for pattern, _ in CONDITIONAL_ROUTES):
+            await self.conditional(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(ConditionalRequests)
+
 # Path to the frontend build directory
 frontend_build_dir = os.path.join(os.path.dirname(__file__), "..", "frontend", "build")
 
 # IMPORTANT: Define API routes BEFORE mounting static files
 
-@app.post("/api/call")
-async def trigger_call(req: CallRequest):
+def place_call(req: CallRequest):
+    """Place a call through Bland.ai with moderation and call limits applied"""
     if not BLAND_API_KEY:
         raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
     
@@ -176,22 +670,20 @@ async def trigger_call(req: CallRequest):
         "wait_for_greeting": True,
         "record": True
     }
+    if PUBLIC_URL:
+        call_data["webhook"] = f"{PUBLIC_URL.rstrip('/')}/api/webhooks/bland"
     
     try:
         # Make the call to Bland.ai
-        resp = requests.post(bland_url, json=call_data, headers=headers)
+        with upstream_slot("bland"):
+            resp = requests.post(bland_url, json=call_data, headers=headers)
         
         if resp.ok:
             data = resp.json()
             call_id = data.get("call_id")
             
-            # Summarize the topic if possible
-            summary = ""
-            try:
-                summary_resp = await summarize_topic_internal(req.topic)
-                summary = summary_resp.get("summary") if summary_resp else ""
-            except:
-                summary = req.topic
+            # Summaries are computed after the call is placed unless this topic was seen before
+            summary = topic_summarizer.cached(req.topic)
                 
             # Store in our in-memory history (fallback)
             new_call = {
@@ -207,6 +699,10 @@ async def trigger_call(req: CallRequest):
                 
             call_history[req.phone_number].append(new_call)
             
+            # Precompute transcript and recording once the call ends
+            post_call_pipeline.watch(call_id, req.user_id)
+            call_analytics.record_call_placed(call_id, req.user_id)
+            
             # Save to Supabase if possible
             if supabase and req.user_id:
                 try:
@@ -222,6 +718,9 @@ async def trigger_call(req: CallRequest):
                 except Exception as e:
                     print(f"Error saving call to Supabase: {str(e)}")
             
+            if summary is None:
+                topic_summarizer.backfill(call_id, req.user_id, req.phone_number, req.topic)
+            
             # Return call info
             return {
                 "message": "Bland.ai call triggered!",
@@ -241,22 +740,505 @@ async def trigger_call(req: CallRequest):
                 call_history[req.phone_number] = []
                 
             call_history[req.phone_number].append(new_call)
+            call_analytics.record_call_failed(req.user_id)
             
             raise HTTPException(status_code=500, detail=f"Bland.ai call failed: {resp.text}")
+    except UpstreamBusy:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calling Bland.ai: {e}")
 
-def improve_transcript_readability(text):
+@app.post("/api/call")
+def trigger_call(req: CallRequest):
+    return place_call(req)
+
+def punctuate_transcript(text):
     # Add punctuation if model is available
     if punctuation_model:
         try:
             text = punctuation_model.restore_punctuation(text)
         except Exception:
             pass
+    return text
+
+def split_sentences(text):
     # Split into sentences for readability
     sentences = re.split(r'(?<=[.!?]) +', text)
     return '\n'.join(sentences)
 
+def improve_transcript_readability(text):
+    return split_sentences(punctuate_transcript(text))
+
+# Stored transcripts keep only the segment list: speaker labels are interned into a
+# table and referenced by index, and the payload is zlib-compressed above a threshold.
+# The plain-text transcript is derived from the segments when needed.
+TRANSCRIPT_FORMAT_VERSION = 2
+TRANSCRIPT_COMPRESS_THRESHOLD = 2048  # bytes of JSON
+
+def encode_aligned(aligned: List[Dict[str, Any]]) -> dict:
+    """Compact aligned_transcript value: {"v", "speakers", "segments"} or {"v", "z"} when compressed"""
+    speakers: List[str] = []
+    speaker_ids: Dict[str, int] = {}
+    segments = []
+    for segment in aligned:
+        speaker = segment.get("speaker", "Unknown")
+        if speaker not in speaker_ids:
+            speaker_ids[speaker] = len(speakers)
+            speakers.append(speaker)
+        segments.append([speaker_ids[speaker], segment.get("text", "")])
+    
+    body = {"speakers": speakers, "segments": segments}
+    raw = json.dumps(body, separators=(",", ":"))
+    if len(raw) > TRANSCRIPT_COMPRESS_THRESHOLD:
+        return {"v": TRANSCRIPT_FORMAT_VERSION, "z": base64.b64encode(zlib.compress(raw.encode("utf-8"), 9)).decode("ascii")}
+    return {"v": TRANSCRIPT_FORMAT_VERSION, **body}
+
+def load_aligned(value) -> Optional[List[Dict[str, Any]]]:
+    """Decode a stored aligned_transcript value into a list of segments.
+    
+    Accepts the compact format as well as older rows, which hold the segment
+    list itself as a JSON string.
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    if isinstance(value, dict) and value.get("v") == TRANSCRIPT_FORMAT_VERSION:
+        if "z" in value:
+            value = json.loads(zlib.decompress(base64.b64decode(value["z"])))
+        speakers = [sys.intern(speaker) for speaker in value["speakers"]]
+        return [{"speaker": speakers[speaker_id], "text": text} for speaker_id, text in value["segments"]]
+    return value
+
+def transcript_text(aligned: List[Dict[str, Any]]) -> str:
+    """Plain-text "Speaker: text" view of a transcript"""
+    lines = []
+    for segment in aligned or []:
+        text = segment.get("text", "").strip()
+        if text:
+            lines.append(f"{segment.get('speaker', 'Unknown')}: {text}\n")
+    return "".join(lines)
+
+def aligned_from_text(transcript: str) -> List[Dict[str, Any]]:
+    """Split "Speaker: text" lines into segments (for rows stored without aligned data)"""
+    aligned = []
+    for line in (transcript or "").split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        speaker, sep, text = line.partition(":")
+        if sep and speaker in ("Agent", "User", "AI", "Human"):
+            aligned.append({"speaker": speaker, "text": text.strip()})
+        else:
+            aligned.append({"speaker": "Unknown", "text": line})
+    return aligned
+
+def save_transcript(call_id: str, user_id: Optional[str], aligned: List[Dict[str, Any]]) -> bool:
+    """Persist a transcript to Supabase and add it to the search index; False if it could not be stored"""
+    if not user_id:
+        return False
+    
+    if supabase:
+        try:
+            db_transcript = {
+                "call_id": call_id,
+                "user_id": user_id,
+                "aligned_transcript": encode_aligned(aligned)
+            }
+            supabase.table("call_transcript").upsert(db_transcript, on_conflict="call_id").execute()
+        except Exception as e:
+            print(f"Error saving transcript to Supabase: {str(e)}")
+            return False
+    
+    transcript_index.add(user_id, call_id, aligned)
+    return True
+
+# --- Transcript search ---
+SEARCH_TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+SEARCH_QUERY_RE = re.compile(r'(\w+):("[^"]*"|\S+)|"([^"]*)"|(\S+)')
+SEARCH_SPEAKERS = {"agent": "Agent", "ai": "Agent", "user": "User", "human": "User"}
+SEARCH_SNIPPETS = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_SYNC_OVERLAP = timedelta(minutes=5)  # catch-up re-reads rows committed around the last sync
+
+def search_tokens(text: str) -> List[str]:
+    return SEARCH_TOKEN_RE.findall(text.lower())
+
+class TranscriptIndex:
+    """Positional inverted index over call transcripts, stored in SQLite.
+    
+    Every query is scoped to one user. postings holds the positions of a term
+    in one call's transcript; positions run across the whole transcript, with
+    a gap between segments so phrases never match across a speaker change.
+    Each call's segment start positions and speakers map a position back to
+    its speaker, and its (compressed) segments are only read to build snippets
+    for the results returned. Nothing is held in memory between queries, and
+    the index survives restarts: the first start builds it from Supabase,
+    later ones only catch up on transcripts created since the last sync.
+    """
+    
+    def __init__(self, filename: str = "transcript_index.db"):
+        self.filename = filename
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.ready = False
+    
+    def start(self):
+        self.conn = open_local_db(self.filename)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS postings (
+                user_id TEXT NOT NULL,
+                term TEXT NOT NULL,
+                call_id TEXT NOT NULL,
+                positions BLOB NOT NULL,
+                PRIMARY KEY (user_id, term, call_id)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                user_id TEXT NOT NULL,
+                call_id TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                terms TEXT NOT NULL,
+                segment_starts BLOB NOT NULL,
+                speakers TEXT NOT NULL,
+                segments BLOB NOT NULL,
+                PRIMARY KEY (user_id, call_id)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS index_users (user_id TEXT PRIMARY KEY, doc_count INTEGER NOT NULL, total_length INTEGER NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.ready = self._meta("synced_at") is not None
+    
+    def _meta(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM index_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_meta(self, key: str, value: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def add(self, user_id: str, call_id: str, aligned: Optional[List[Dict[str, Any]]]):
+        self.add_many([(user_id, call_id, aligned)])
+    
+    def add_many(self, transcripts: List[tuple]):
+        """Index (user_id, call_id, aligned) transcripts in one transaction, replacing earlier versions"""
+        if not self.conn:
+            return
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for user_id, call_id, aligned in transcripts:
+                    if user_id and call_id and aligned:
+                        self._add(user_id, call_id, aligned)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def _add(self, user_id: str, call_id: str, aligned: List[Dict[str, Any]]):
+        # Caller holds self.lock inside a transaction
+        self._remove(user_id, call_id)
+        
+        segments = []
+        segment_starts = []
+        doc_terms: Dict[str, List[int]] = {}
+        position = 0
+        for segment in aligned:
+            text = (segment.get("text") or "").strip()
+            if not text:
+                continue
+            speaker = SEARCH_SPEAKERS.get(str(segment.get("speaker", "")).lower(), segment.get("speaker", "Unknown"))
+            segment_starts.append(position)
+            segments.append([speaker, text])
+            for token in search_tokens(text):
+                doc_terms.setdefault(token, []).append(position)
+                position += 1
+            position += 1  # gap between segments
+        
+        length = sum(len(positions) for positions in doc_terms.values())
+        self.conn.executemany(
+            "INSERT INTO postings (user_id, term, call_id, positions) VALUES (?, ?, ?, ?)",
+            [(user_id, term, call_id, array("I", positions).tobytes()) for term, positions in doc_terms.items()]
+        )
+        self.conn.execute(
+            "INSERT INTO documents (user_id, call_id, length, terms, segment_starts, speakers, segments) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                user_id, call_id, length, json.dumps(list(doc_terms)),
+                array("I", segment_starts).tobytes(),
+                json.dumps([speaker for speaker, _ in segments]),
+                zlib.compress(json.dumps(segments).encode("utf-8"))
+            )
+        )
+        self.conn.execute(
+            """INSERT INTO index_users (user_id, doc_count, total_length) VALUES (?, 1, ?)
+               ON CONFLICT (user_id) DO UPDATE SET doc_count = doc_count + 1, total_length = total_length + excluded.total_length""",
+            (user_id, length)
+        )
+    
+    def _remove(self, user_id: str, call_id: str):
+        row = self.conn.execute(
+            "SELECT terms, length FROM documents WHERE user_id = ? AND call_id = ?",
+            (user_id, call_id)
+        ).fetchone()
+        if not row:
+            return
+        terms, length = row
+        self.conn.executemany(
+            "DELETE FROM postings WHERE user_id = ? AND term = ? AND call_id = ?",
+            [(user_id, term, call_id) for term in json.loads(terms)]
+        )
+        self.conn.execute("DELETE FROM documents WHERE user_id = ? AND call_id = ?", (user_id, call_id))
+        self.conn.execute(
+            "UPDATE index_users SET doc_count = doc_count - 1, total_length = total_length - ? WHERE user_id = ?",
+            (length, user_id)
+        )
+    
+    def _select_for_calls(self, sql: str, params: tuple, call_ids) -> list:
+        # Caller holds self.lock; keeps each IN (...) list under SQLite's variable limit
+        call_ids = list(call_ids)
+        rows = []
+        for i in range(0, len(call_ids), 500):
+            chunk = call_ids[i:i + 500]
+            rows.extend(self.conn.execute(sql.format(", ".join("?" * len(chunk))), params + tuple(chunk)).fetchall())
+        return rows
+    
+    def search(self, user_id: str, query: str, limit: int = 20) -> List[dict]:
+        terms, phrases, speaker = parse_search_query(query)
+        required = set(terms + [term for phrase in phrases for term in phrase])
+        if not required or not self.conn:
+            return []
+        
+        with self.lock:
+            stats = self.conn.execute("SELECT doc_count, total_length FROM index_users WHERE user_id = ?", (user_id,)).fetchone()
+            if not stats or not stats[0]:
+                return []
+            doc_count, total_length = stats
+            
+            df = {
+                term: self.conn.execute("SELECT COUNT(*) FROM postings WHERE user_id = ? AND term = ?", (user_id, term)).fetchone()[0]
+                for term in required
+            }
+            # Intersect candidate documents, starting from the rarest term
+            order = sorted(required, key=df.get)
+            if not df[order[0]]:
+                return []
+            postings: Dict[str, Dict[str, bytes]] = {
+                order[0]: dict(self.conn.execute(
+                    "SELECT call_id, positions FROM postings WHERE user_id = ? AND term = ?",
+                    (user_id, order[0])
+                ).fetchall())
+            }
+            candidates = set(postings[order[0]])
+            for term in order[1:]:
+                postings[term] = dict(self._select_for_calls(
+                    "SELECT call_id, positions FROM postings WHERE user_id = ? AND term = ? AND call_id IN ({})",
+                    (user_id, term), candidates
+                ))
+                candidates.intersection_update(postings[term])
+                if not candidates:
+                    return []
+            
+            docs = {
+                call_id: (length, array("I", starts), json.loads(speakers))
+                for call_id, length, starts, speakers in self._select_for_calls(
+                    "SELECT call_id, length, segment_starts, speakers FROM documents WHERE user_id = ? AND call_id IN ({})",
+                    (user_id,), candidates
+                )
+            }
+        
+        def positions_of(term: str, call_id: str) -> List[int]:
+            return array("I", postings[term][call_id]).tolist()
+        
+        def segment_of(call_id: str, position: int) -> int:
+            return bisect.bisect_right(docs[call_id][1], position) - 1
+        
+        def term_positions(term: str, call_id: str) -> List[int]:
+            positions = positions_of(term, call_id)
+            if speaker:
+                positions = [p for p in positions if docs[call_id][2][segment_of(call_id, p)] == speaker]
+            return positions
+        
+        def phrase_positions(phrase: List[str], call_id: str) -> List[int]:
+            """Start positions where the phrase occurs in order"""
+            starts = term_positions(phrase[0], call_id)
+            for offset, term in enumerate(phrase[1:], 1):
+                following = set(positions_of(term, call_id))
+                starts = [p for p in starts if p + offset in following]
+                if not starts:
+                    break
+            return starts
+        
+        avg_length = total_length / doc_count or 1
+        scored = []
+        for call_id in candidates:
+            # Each match is (document frequency, positions); a phrase is as rare as its rarest word
+            matches = [(df[term], term_positions(term, call_id)) for term in terms]
+            for phrase in phrases:
+                matches.append((min(df[term] for term in phrase), phrase_positions(phrase, call_id)))
+            if any(not positions for _, positions in matches):
+                continue
+            
+            score = 0.0
+            for frequency, positions in matches:
+                idf = math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+                tf = len(positions)
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * docs[call_id][0] / avg_length))
+            scored.append((score, call_id, [positions for _, positions in matches]))
+        
+        top = heapq.nlargest(limit, scored)
+        with self.lock:
+            segments = {
+                call_id: json.loads(zlib.decompress(blob))
+                for call_id, blob in self._select_for_calls(
+                    "SELECT call_id, segments FROM documents WHERE user_id = ? AND call_id IN ({})",
+                    (user_id,), [call_id for _, call_id, _ in top]
+                )
+            }
+        
+        results = []
+        for score, call_id, match_positions in top:
+            segment_ids = []
+            for p in sorted({p for positions in match_positions for p in positions}):
+                segment_id = segment_of(call_id, p)
+                if segment_id not in segment_ids:
+                    segment_ids.append(segment_id)
+                    if len(segment_ids) == SEARCH_SNIPPETS:
+                        break
+            results.append({
+                "call_id": call_id,
+                "score": round(score, 4),
+                "matches": [{"speaker": segments[call_id][i][0], "text": segments[call_id][i][1]} for i in segment_ids]
+            })
+        return results
+    
+    def _fetch_page(self, query):
+        while True:
+            try:
+                return query().execute().data or []
+            except UpstreamBusy:
+                # Supabase is saturated by live traffic - back off and retry this page
+                time.sleep(UPSTREAM_WAIT)
+    
+    def _index_rows(self, rows: List[dict]) -> int:
+        transcripts = []
+        for row in rows:
+            if not row.get("user_id"):
+                continue
+            try:
+                aligned = load_aligned(row.get("aligned_transcript")) or aligned_from_text(row.get("transcript"))
+                if not isinstance(aligned, list) or not all(isinstance(segment, dict) for segment in aligned):
+                    raise ValueError("segments are not a list of objects")
+            except Exception as e:
+                # One corrupt row must not stop the build (it would fail on the same page after every restart)
+                print(f"Unreadable aligned transcript for call {row.get('call_id')}, indexing its plain text instead: {str(e)}")
+                aligned = aligned_from_text(row.get("transcript"))
+            transcripts.append((row["user_id"], row["call_id"], aligned))
+        self.add_many(transcripts)
+        return len(transcripts)
+    
+    def sync_from_supabase(self, page_size: int = 1000):
+        """Build the index from call_transcript on first start, or catch up on rows created since the last sync"""
+        if not supabase:
+            self.ready = True
+            return
+        
+        columns = "call_id, user_id, transcript, aligned_transcript, created_at"
+        sync_started = datetime.now(timezone.utc).isoformat()
+        indexed = 0
+        try:
+            synced_at = self._meta("synced_at")
+            if synced_at is None:
+                # Full build, keyset-paginated on call_id and resumable from the last page indexed
+                if self._meta("build_started") is None:
+                    self._set_meta("build_started", sync_started)
+                last_call_id = self._meta("build_after")
+                while True:
+                    def page():
+                        query = supabase.table("call_transcript").select(columns)
+                        if last_call_id:
+                            query = query.gt("call_id", last_call_id)
+                        return query.order("call_id").limit(page_size)
+                    rows = self._fetch_page(page)
+                    if not rows:
+                        break
+                    indexed += self._index_rows(rows)
+                    last_call_id = rows[-1]["call_id"]
+                    self._set_meta("build_after", last_call_id)
+                    if len(rows) < page_size:
+                        break
+                # Rows written by other instances while the build ran are picked up by the next catch-up
+                synced_at = self._meta("build_started")
+            else:
+                last_created = (datetime.fromisoformat(synced_at) - SEARCH_SYNC_OVERLAP).isoformat()
+                while True:
+                    def page():
+                        return supabase.table("call_transcript").select(columns)\
+                            .gt("created_at", last_created)\
+                            .order("created_at")\
+                            .limit(page_size)
+                    rows = self._fetch_page(page)
+                    if not rows:
+                        break
+                    indexed += self._index_rows(rows)
+                    last_created = rows[-1]["created_at"]
+                    if len(rows) < page_size:
+                        break
+                synced_at = sync_started
+            
+            self._set_meta("synced_at", synced_at)
+            print(f"Transcript search index synced ({indexed} transcripts indexed)")
+        except Exception as e:
+            print(f"Error building transcript search index: {str(e)}")
+        self.ready = True
+
+def parse_search_query(query: str):
+    """Split a query into plain terms, quoted phrases and an optional speaker:agent/user filter"""
+    terms: List[str] = []
+    phrases: List[List[str]] = []
+    speaker = None
+    for field, field_value, phrase, word in SEARCH_QUERY_RE.findall(query):
+        if field.lower() == "speaker":
+            speaker = SEARCH_SPEAKERS.get(field_value.strip('"').lower(), field_value.strip('"'))
+        elif field:
+            terms.extend(search_tokens(f"{field} {field_value}"))
+        elif phrase:
+            tokens = search_tokens(phrase)
+            if len(tokens) == 1:
+                terms.extend(tokens)
+            elif tokens:
+                phrases.append(tokens)
+        else:
+            terms.extend(search_tokens(word))
+    return terms, phrases, speaker
+
+transcript_index = TranscriptIndex()
+
+@app.on_event("startup")
+def start_transcript_index():
+    transcript_index.start()
+    threading.Thread(target=transcript_index.sync_from_supabase, name="transcript-index", daemon=True).start()
+
+@app.get("/api/search")
+def search_transcripts(q: str, user_id: Optional[str] = None, limit: int = 20):
+    """Search a user's call transcripts.
+    
+    Supports plain terms (all must match), "quoted phrases" and
+    speaker:agent / speaker:user to only match what one side said.
+    """
+    if not user_id:
+        return {"results": [], "indexing": not transcript_index.ready}
+    
+    started = time.perf_counter()
+    results = transcript_index.search(user_id, q, max(1, min(limit, 100)))
+    return {
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2),
+        "indexing": not transcript_index.ready
+    }
+
 @app.get("/api/history/{phone_number}")
 def get_history(phone_number: str, user_id: Optional[str] = None):
     """Get call history for a specific phone number"""
@@ -324,197 +1306,392 @@ def get_user_history(user_id: Optional[str] = None):
     all_user_calls.sort(key=lambda x: x.get("call_time", ""), reverse=True)
     return all_user_calls
 
+# --- Data export ---
+EXPORT_PAGE_SIZE = 500
+EXPORT_CSV_COLUMNS = ["call_id", "call_time", "phone_number", "topic", "summary", "status", "call_duration", "recording_url", "transcript"]
+
+def iter_call_history_pages(user_id: str, page_size: int = EXPORT_PAGE_SIZE):
+    """Yield a user's call_history rows a page at a time, keyset-paginated on id"""
+    last_id = None
+    while True:
+        query = supabase.table("call_history")\
+            .select("*")\
+            .eq("user_id", user_id)
+        if last_id:
+            query = query.gt("id", last_id)
+        rows = query.order("id").limit(page_size).execute().data or []
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]["id"]
+
+def iter_export_rows(user_id: str, pages):
+    """Join each page of calls with its stored transcripts"""
+    for calls in pages:
+        call_ids = [call["call_id"] for call in calls if call.get("call_id")]
+        transcripts = {}
+        if call_ids:
+            response = supabase.table("call_transcript")\
+                .select("call_id, transcript, aligned_transcript")\
+                .eq("user_id", user_id)\
+                .in_("call_id", call_ids)\
+                .execute()
+            transcripts = {row["call_id"]: row for row in response.data or []}
+        
+        for call in calls:
+            stored = transcripts.get(call.get("call_id"))
+            call["aligned"] = load_aligned(stored.get("aligned_transcript")) if stored else None
+            call["transcript"] = (stored.get("transcript") or transcript_text(call["aligned"])) if stored else None
+            yield call
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, default=str) + "\n"
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def ndjson_error(message: str) -> str:
+    return json.dumps({"error": f"Export incomplete: {message}", "complete": False}) + "\n"
+
+def export_stream(lines, error_line=None):
+    """Abort the response if Supabase fails mid-export.
+    
+    The 200 has already been sent, so the only way to tell the client is to
+    end the body with an error (NDJSON) and drop the connection without the
+    final chunk - a cut-off file can then never pass as a complete export.
+    """
+    try:
+        yield from lines
+    except Exception as e:
+        print(f"Error exporting call history: {str(e)}")
+        if error_line:
+            yield error_line(str(e))
+        raise
+
+@app.get("/api/export")
+def export_calls(user_id: Optional[str] = None, format: str = "ndjson"):
+    """Stream all of a user's calls with their transcripts as NDJSON or CSV"""
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID is required")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    if not supabase:
+        raise HTTPException(status_code=500, detail="Supabase client not initialized")
+    
+    rows = iter_export_rows(user_id, iter_call_history_pages(user_id))
+    if format == "csv":
+        lines, media_type, error_line = csv_lines(rows), "text/csv", None
+    else:
+        lines, media_type, error_line = ndjson_lines(rows), "application/x-ndjson", ndjson_error
+    
+    return StreamingResponse(
+        export_stream(lines, error_line),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="calls.{format}"'}
+    )
+
 @app.get("/api/call_details/{call_id}")
 def get_call_details(call_id: str):
     """Get details for a specific call from Bland.ai"""
     if not BLAND_API_KEY:
         raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
     
+    # Finished calls are cached by the post-call pipeline
+    cached = call_details_cache.get(call_id)
+    if cached:
+        return cached
+    
     bland_url = f"https://api.bland.ai/v1/calls/{call_id}"
     headers = {'Authorization': BLAND_API_KEY}
     
     try:
-        resp = requests.get(bland_url, headers=headers)
+        with upstream_slot("bland"):
+            resp = requests.get(bland_url, headers=headers)
         if resp.ok:
             return resp.json()
         else:
             raise HTTPException(status_code=resp.status_code, detail=f"Failed to get call details: {resp.text}")
+    except UpstreamBusy:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting call details: {str(e)}")
 
-@app.get("/api/call_transcript/{call_id}")
-def get_call_transcript(call_id: str, user_id: Optional[str] = None):
-    """Get call transcript for a specific call"""
-    if not BLAND_API_KEY:
-        raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
+# --- Transcript loading ---
+TRANSCRIPT_CACHE_SIZE = 1000
+
+class TranscriptState:
+    """Normalized transcript for one call, extended in place while the call is live.
     
-    # First try Supabase for stored transcript
-    if supabase and user_id:
-        try:
-            response = supabase.table("call_transcript")\
-                .select("*")\
-                .eq("call_id", call_id)\
-                .single()\
-                .execute()
-                
-            if response.data:
-                return {
-                    "status": "success", 
-                    "transcript": response.data.get("transcript"),
-                    "aligned": json.loads(response.data.get("aligned_transcript")) if response.data.get("aligned_transcript") else None
-                }
-        except Exception as e:
-            print(f"Error retrieving transcript from Supabase: {str(e)}")
+    raw_count and text_offset record how much of Bland's transcript has already
+    been normalized, so each poll only processes what was added since the last
+    one; tail_length is how long the unconsumed tail was at the last poll. generation changes whenever the segment list is replaced wholesale
+    (by the corrected transcript, or the final re-normalization of a plain-text
+    transcript), which invalidates client cursors. The plain-text view is only
+    built when a response asks for it. saved_for is the user the final
+    transcript was stored for; requests without a user_id can finish a call's
+    transcript before anyone is known to own it.
+    """
+    
+    def __init__(self, call_id: str, user_id: Optional[str], segments: Optional[List[Dict[str, Any]]] = None, text: Optional[str] = None, final: bool = False):
+        self.call_id = call_id
+        self.user_id = user_id
+        self.generation = uuid.uuid4().hex[:8]
+        self.segments: List[Dict[str, Any]] = segments or []
+        self.final = final
+        self.saved_for: Optional[str] = None
+        self.raw_count = 0
+        self.text_offset = 0
+        self.tail_length = 0
+        self.lock = threading.Lock()
+        self._text = text
+        self._text_key = (self.generation, len(self.segments)) if text is not None else None
     
-    # Try to get corrected transcript first (better quality)
+    @property
+    def text(self) -> str:
+        key = (self.generation, len(self.segments))
+        if self._text_key != key:
+            self._text = transcript_text(self.segments)
+            self._text_key = key
+        return self._text
+    
+    def replace_segments(self, segments: List[Dict[str, Any]]):
+        self.segments = segments
+        self.generation = uuid.uuid4().hex[:8]
+
+transcript_cache: "OrderedDict[str, TranscriptState]" = OrderedDict()
+transcript_cache_lock = threading.Lock()
+
+def cache_transcript(state: TranscriptState) -> TranscriptState:
+    with transcript_cache_lock:
+        transcript_cache[state.call_id] = state
+        transcript_cache.move_to_end(state.call_id)
+        while len(transcript_cache) > TRANSCRIPT_CACHE_SIZE:
+            transcript_cache.popitem(last=False)
+    return state
+
+def cached_transcript(call_id: str) -> Optional[TranscriptState]:
+    with transcript_cache_lock:
+        state = transcript_cache.get(call_id)
+        if state:
+            transcript_cache.move_to_end(call_id)
+        return state
+
+# A sentence is only known to be finished once more text follows its punctuation
+TRANSCRIPT_SENTENCE_END_RE = re.compile(r"[.!?](?=\s)")
+# A live tail with no sentence boundary is shown anyway once it is this long, or stops growing
+TRANSCRIPT_LIVE_TAIL_WORDS = 20
+
+def append_transcript_lines(aligned: List[Dict[str, Any]], lines: List[str]):
+    """Turn readability-improved lines into Agent/User segments"""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        # Check for speaker change
+        if line.startswith("AI:") or line.startswith("Agent:"):
+            aligned.append({"speaker": "Agent", "text": line.split(":", 1)[1].strip()})
+        elif line.startswith("Human:") or line.startswith("User:"):
+            aligned.append({"speaker": "User", "text": line.split(":", 1)[1].strip()})
+        elif not aligned:
+            # If transcript is a single block, alternate speakers every sentence
+            aligned.append({"speaker": "Agent", "text": line})
+        else:
+            # Alternate speakers for each new sentence if no prefix
+            current_speaker = "User" if aligned[-1]["speaker"] == "Agent" else "Agent"
+            aligned.append({"speaker": current_speaker, "text": line})
+
+def load_stored_transcript(call_id: str, user_id: Optional[str]) -> Optional[TranscriptState]:
+    if not (supabase and user_id):
+        return None
+    try:
+        response = supabase.table("call_transcript")\
+            .select("*")\
+            .eq("call_id", call_id)\
+            .single()\
+            .execute()
+            
+        if response.data:
+            # Older rows also stored the text; newer ones derive it from the segments
+            transcript = response.data.get("transcript")
+            aligned = load_aligned(response.data.get("aligned_transcript")) or aligned_from_text(transcript)
+            state = TranscriptState(call_id, user_id, aligned, transcript, final=True)
+            state.saved_for = user_id
+            return state
+    except Exception as e:
+        print(f"Error retrieving transcript from Supabase: {str(e)}")
+    return None
+
+def fetch_corrected_transcript(call_id: str, user_id: Optional[str]) -> Optional[TranscriptState]:
+    """Corrected transcript from Bland.ai - only exists once the call has finished"""
     try:
         corrected_url = f"https://api.bland.ai/v1/calls/{call_id}/correct"
         headers = {'Authorization': BLAND_API_KEY}
         
-        corrected_resp = requests.get(corrected_url, headers=headers)
+        with upstream_slot("bland"):
+            corrected_resp = requests.get(corrected_url, headers=headers)
         if corrected_resp.ok:
-            corrected_data = corrected_resp.json()
-            
-            # If we have corrected/aligned transcript data
-            if corrected_data.get("aligned"):
-                aligned = corrected_data.get("aligned")
-                concat_transcript = ""
-                
-                # Format transcript text
-                for segment in aligned:
-                    speaker = segment.get("speaker", "Unknown")
-                    text = segment.get("text", "").strip()
-                    if text:
-                        concat_transcript += f"{speaker}: {text}\n"
-                
-                # Save to Supabase if possible
-                if supabase and user_id:
-                    try:
-                        db_transcript = {
-                            "call_id": call_id,
-                            "user_id": user_id,
-                            "transcript": concat_transcript,
-                            "aligned_transcript": json.dumps(aligned)
-                        }
-                        supabase.table("call_transcript").upsert(db_transcript).execute()
-                    except Exception as e:
-                        print(f"Error saving corrected transcript to Supabase: {str(e)}")
-                
-                return {"status": "success", "transcript": concat_transcript, "aligned": aligned}
+            aligned = corrected_resp.json().get("aligned")
+            if aligned:
+                return TranscriptState(call_id, user_id, aligned, final=True)
     except Exception as e:
         print(f"Error getting corrected transcript: {str(e)}")
-        # Fall back to regular transcript below
+    return None
+
+def refresh_live_transcript(state: TranscriptState):
+    """Normalize whatever Bland.ai has added to the call's transcript since the last refresh"""
+    bland_url = f"https://api.bland.ai/v1/calls/{state.call_id}"
+    headers = {'Authorization': BLAND_API_KEY}
     
-    # If corrected transcript fails, fall back to regular transcript
-    try:
-        # Get call details which includes transcript from Bland.ai
-        bland_url = f"https://api.bland.ai/v1/calls/{call_id}"
-        headers = {'Authorization': BLAND_API_KEY}
-        
+    with upstream_slot("bland"):
         resp = requests.get(bland_url, headers=headers)
-        if not resp.ok:
-            raise HTTPException(status_code=resp.status_code, detail=f"Failed to get call transcript: {resp.text}")
-        
-        data = resp.json()
-        
-        # Check for transcript API v2 (aligned transcript)
-        if data.get("transcript_aligned"):
-            aligned = []
-            concat_transcript = ""
-            
-            for segment in data.get("transcript_aligned", []):
-                speaker = "Agent" if segment.get("from") == "ai" else "User"
-                text = segment.get("text", "").strip()
-                if text:
-                    aligned.append({"speaker": speaker, "text": text})
-                    concat_transcript += f"{speaker}: {text}\n"
-                    
-            # Save to Supabase if possible
-            if supabase and user_id:
-                try:
-                    db_transcript = {
-                        "call_id": data.get("call_id"),
-                        "user_id": user_id,
-                        "transcript": concat_transcript,
-                        "aligned_transcript": json.dumps(aligned)
-                    }
-                    supabase.table("call_transcript").insert(db_transcript).execute()
-                except Exception as e:
-                    print(f"Error saving transcript to Supabase: {str(e)}")
-            
-            return {"status": "success", "transcript": concat_transcript, "aligned": aligned}
-        
-        # Check for transcript field
-        elif data.get("transcript"):
-            transcript = data.get("transcript", "")
-            # IMPROVEMENT: Add punctuation and sentence segmentation
-            improved_transcript = improve_transcript_readability(transcript)
-            # Process transcript to create agent/user segments
-            try:
-                aligned = []
-                lines = improved_transcript.split("\n")
-                current_speaker = None
-                for idx, line in enumerate(lines):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    # Check for speaker change
-                    if line.startswith("AI:") or line.startswith("Agent:"):
-                        current_speaker = "Agent"
-                        text = line.split(":", 1)[1].strip()
-                        aligned.append({"speaker": current_speaker, "text": text})
-                    elif line.startswith("Human:") or line.startswith("User:"):
-                        current_speaker = "User"
-                        text = line.split(":", 1)[1].strip()
-                        aligned.append({"speaker": current_speaker, "text": text})
-                    else:
-                        # If transcript is a single block, alternate speakers every sentence
-                        if not aligned:
-                            current_speaker = "Agent"
-                            aligned.append({"speaker": current_speaker, "text": line})
-                        else:
-                            # Alternate speakers for each new sentence if no prefix
-                            current_speaker = "User" if aligned[-1]["speaker"] == "Agent" else "Agent"
-                            aligned.append({"speaker": current_speaker, "text": line})
-                if aligned:
-                    # Save to Supabase if possible
-                    if supabase and user_id:
-                        try:
-                            db_transcript = {
-                                "call_id": data.get("call_id"),
-                                "user_id": user_id,
-                                "transcript": improved_transcript,
-                                "aligned_transcript": json.dumps(aligned)
-                            }
-                            supabase.table("call_transcript").insert(db_transcript).execute()
-                        except Exception as e:
-                            print(f"Error saving transcript to Supabase: {str(e)}")
-                    
-                    return {"status": "success", "transcript": improved_transcript, "aligned": aligned}
-            except Exception as e:
-                print(f"Error processing concatenated transcript: {str(e)}")
-                
-        # Check if call is still in progress
-        if data.get("status") == "in-progress" or data.get("completed") is False:
-            return {"status": "pending", "message": "Call still in progress, transcript not available yet"}
-            
-        return {"status": "error", "message": "Transcript not available for this call"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting call transcript: {str(e)}")
+    if not resp.ok:
+        raise HTTPException(status_code=resp.status_code, detail=f"Failed to get call transcript: {resp.text}")
+    
+    data = resp.json()
+    completed = not (data.get("status") == "in-progress" or data.get("completed") is False)
+    
+    # Check for transcript API v2 (aligned transcript)
+    if data.get("transcript_aligned"):
+        raw_segments = data.get("transcript_aligned")
+        for segment in raw_segments[state.raw_count:]:
+            speaker = "Agent" if segment.get("from") == "ai" else "User"
+            text = segment.get("text", "").strip()
+            if text:
+                state.segments.append({"speaker": speaker, "text": text})
+        state.raw_count = len(raw_segments)
+    
+    # Check for transcript field
+    elif data.get("transcript"):
+        transcript = data.get("transcript", "")
+        if completed:
+            # Speakers alternate per sentence, so normalize the whole call in one pass;
+            # what gets stored must not depend on when the live polls happened
+            segments: List[Dict[str, Any]] = []
+            append_transcript_lines(segments, improve_transcript_readability(transcript).split("\n"))
+            state.replace_segments(segments)
+            state.text_offset = len(transcript)
+        else:
+            # While the call is live, only take complete sentences; the unfinished tail waits for the next poll.
+            # Bland's text often has no punctuation, so boundaries are found after punctuating the tail.
+            tail = transcript[state.text_offset:]
+            words = list(re.finditer(r"\S+", tail))
+            punctuated = punctuate_transcript(tail.strip())
+            cut = 0
+            for match in TRANSCRIPT_SENTENCE_END_RE.finditer(punctuated):
+                cut = match.end()
+            if cut:
+                # The model only adds punctuation, so the finished sentences cover the same number of words
+                consumed = min(len(punctuated[:cut].split()), len(words))
+                end = words[consumed - 1].end() if consumed else 0
+            elif words and (len(words) >= TRANSCRIPT_LIVE_TAIL_WORDS or len(tail) == state.tail_length):
+                cut, end = len(punctuated), len(tail)
+            else:
+                end = 0
+            chunk = punctuated[:cut].strip()
+            if chunk:
+                append_transcript_lines(state.segments, split_sentences(chunk).split("\n"))
+            state.text_offset += end
+            state.tail_length = len(tail) - end
+    
+    state.final = completed
 
-@app.get("/api/call_recording/{call_id}")
-def get_call_recording(call_id: str):
-    """Get call audio recording URL for a specific call"""
-    if not BLAND_API_KEY:
-        raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
+def load_transcript(call_id: str, user_id: Optional[str]) -> TranscriptState:
+    """Get a call's transcript, doing only the work that is new since the last request"""
+    state = cached_transcript(call_id)
+    if not state:
+        # First try Supabase for stored transcript, then the corrected transcript (better quality)
+        stored = load_stored_transcript(call_id, user_id) or fetch_corrected_transcript(call_id, user_id)
+        state = cache_transcript(stored or TranscriptState(call_id, user_id))
     
-    # Get recording URL from Bland.ai
-    bland_url = f"https://api.bland.ai/v1/calls/{call_id}/recording"
-    headers = {'Authorization': BLAND_API_KEY}
+    if not state.final:
+        with state.lock:
+            if not state.final:
+                refresh_live_transcript(state)
+                if state.final:
+                    # The call just ended - prefer the corrected transcript if Bland.ai has one
+                    corrected = fetch_corrected_transcript(call_id, user_id)
+                    if corrected:
+                        state = cache_transcript(corrected)
     
-    try:
-        resp = requests.get(bland_url, headers=headers)
-        if not resp.ok:
+    # Store a finished transcript the first time a request knows who owns the call
+    if state.final and state.segments and user_id and not state.saved_for:
+        with state.lock:
+            if not state.saved_for and save_transcript(call_id, user_id, state.segments):
+                state.saved_for = user_id
+    return state
+
+def transcript_response(state: TranscriptState, cursor: Optional[str] = None) -> dict:
+    """Full transcript, or with a cursor only the segments added since that cursor"""
+    segments = state.segments[:]
+    next_cursor = f"{state.generation}:{len(segments)}"
+    
+    if segments:
+        response = {"status": "success"}
+    elif state.final:
+        response = {"status": "error", "message": "Transcript not available for this call"}
+    else:
+        response = {"status": "pending", "message": "Call still in progress, transcript not available yet"}
+    
+    if cursor is None:
+        if segments:
+            response.update({"transcript": state.text, "aligned": segments})
+    else:
+        generation, _, offset = cursor.partition(":")
+        start = int(offset) if offset.isdigit() else -1
+        # A cursor from an older generation or beyond the end can't be resumed - resend everything
+        reset = generation != state.generation or not 0 <= start <= len(segments)
+        response.update({"aligned": segments if reset else segments[start:], "reset": reset})
+    
+    response.update({"cursor": next_cursor, "completed": state.final})
+    return response
+
+@app.get("/api/call_transcript/{call_id}")
+def get_call_transcript(call_id: str, user_id: Optional[str] = None, cursor: Optional[str] = None):
+    """Get call transcript for a specific call.
+    
+    Pass the cursor from the previous response to get only the segments
+    added since then; "reset": true means the client should replace what
+    it has with "aligned" instead of appending.
+    """
+    if not BLAND_API_KEY:
+        raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
+    
+    try:
+        return transcript_response(load_transcript(call_id, user_id), cursor)
+    except UpstreamBusy:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting call transcript: {str(e)}")
+
+@app.get("/api/call_recording/{call_id}")
+def get_call_recording(call_id: str):
+    """Get call audio recording URL for a specific call"""
+    if not BLAND_API_KEY:
+        raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
+    
+    recording_url = call_recording_cache.get(call_id)
+    if recording_url:
+        return {"status": "success", "recording_url": recording_url}
+    
+    # Get recording URL from Bland.ai
+    bland_url = f"https://api.bland.ai/v1/calls/{call_id}/recording"
+    headers = {'Authorization': BLAND_API_KEY}
+    
+    try:
+        with upstream_slot("bland"):
+            resp = requests.get(bland_url, headers=headers)
+        if not resp.ok:
             raise HTTPException(status_code=resp.status_code, detail=f"Failed to get call recording: {resp.text}")
         
         data = resp.json()
@@ -522,446 +1699,1640 @@ def get_call_recording(call_id: str):
             return {"status": "success", "recording_url": data.get("url")}
         else:
             return {"status": "error", "message": "Recording not available"}
+    except UpstreamBusy:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting call recording: {str(e)}")
 
-@app.post("/api/chat_history")
-async def save_chat(request: Request):
-    """Save chat message to history"""
-    body = await request.json()
-    user_id = body.get("user_id")
-    message = body.get("message")
+# --- Post-call precompute ---
+# Once a call ends, fetch and normalize its transcript, recording and details in the
+# background so the first time a user opens the call every endpoint is a cache read.
+POST_CALL_WORKERS = int(os.getenv("POST_CALL_WORKERS", "4"))
+POST_CALL_FIRST_CHECK = 30  # seconds after placement before the first status check
+POST_CALL_POLL_INTERVAL = 15  # seconds between status checks while the call is live
+POST_CALL_WATCH_LIMIT = 3600  # stop watching a call that hasn't finished after this long
+POST_CALL_MAX_ATTEMPTS = 5
+POST_CALL_CACHE_SIZE = 1000
+PUBLIC_URL = os.getenv("PUBLIC_URL")  # lets Bland.ai report call completion by webhook
+
+class LRUCache:
+    """Small thread-safe LRU map"""
     
-    if not user_id or not message:
-        raise HTTPException(status_code=400, detail="User ID and message are required")
+    def __init__(self, size: int):
+        self.size = size
+        self.items: "OrderedDict[str, Any]" = OrderedDict()
+        self.lock = threading.Lock()
     
-    if supabase:
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+    
+    def put(self, key: str, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+call_details_cache = LRUCache(POST_CALL_CACHE_SIZE)
+call_recording_cache = LRUCache(POST_CALL_CACHE_SIZE)
+
+# call_history.status values for calls that ended without a conversation; 'pending',
+# 'in-progress' and anything unrecognised mean the outcome isn't known yet
+CALL_FAILED_STATUSES = {"failed", "error", "no-answer", "busy", "canceled", "cancelled"}
+
+def call_is_complete(details: dict) -> bool:
+    return details.get("completed") is True or details.get("status") == "completed"
+
+def finished_call_status(details: dict) -> str:
+    """call_history.status for a call Bland.ai reports as finished"""
+    if details.get("error_message"):
+        return "failed"
+    return details.get("status") or "completed"
+
+def call_succeeded(status: Optional[str]) -> Optional[bool]:
+    """Outcome of a call from its call_history.status, or None while it isn't known"""
+    if status == "completed":
+        return True
+    if status in CALL_FAILED_STATUSES:
+        return False
+    return None
+
+def fetch_call_details(call_id: str) -> dict:
+    with upstream_slot("bland"):
+        resp = requests.get(f"https://api.bland.ai/v1/calls/{call_id}", headers={'Authorization': BLAND_API_KEY}, timeout=10)
+    if not resp.ok:
+        raise HTTPException(status_code=resp.status_code, detail=f"Failed to get call details: {resp.text}")
+    return resp.json()
+
+def fetch_recording_url(call_id: str) -> Optional[str]:
+    with upstream_slot("bland"):
+        resp = requests.get(f"https://api.bland.ai/v1/calls/{call_id}/recording", headers={'Authorization': BLAND_API_KEY}, timeout=10)
+    if not resp.ok:
+        return None
+    data = resp.json()
+    return data.get("url") if data.get("status") == "success" else None
+
+def call_duration_seconds(details: dict) -> Optional[int]:
+    """Bland.ai reports corrected_duration in seconds and call_length in minutes"""
+    try:
+        if details.get("corrected_duration") is not None:
+            return int(float(details["corrected_duration"]))
+        if details.get("call_length") is not None:
+            return int(float(details["call_length"]) * 60)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def update_call_record(call_id: str, user_id: Optional[str], details: dict, recording_url: Optional[str]):
+    """Write the finished call's status, duration and recording back to call_history"""
+    if not (supabase and user_id):
+        return
+    update = {"status": finished_call_status(details)}
+    duration = call_duration_seconds(details)
+    if duration is not None:
+        update["call_duration"] = duration
+    if recording_url:
+        update["recording_url"] = recording_url
+    try:
+        supabase.table("call_history").update(update).eq("call_id", call_id).execute()
+    except Exception as e:
+        print(f"Error updating call in Supabase: {str(e)}")
+
+class PostCallPipeline(DurableQueue):
+    """Durable queue of placed calls to precompute once they finish.
+    
+    Each job is watched by re-checking the call's status on a timer (or
+    sooner, when Bland.ai's webhook reports completion), then run on a
+    bounded worker pool with exponential-backoff retries. Every step is
+    idempotent (transcripts are upserted), so jobs interrupted by a restart
+    are simply run again.
+    """
+    
+    table = "post_call_jobs"
+    id_column = "call_id"
+    due_column = "next_at"
+    ready_status = "watching"
+    
+    def __init__(self, filename: str = "post_call_jobs.db", workers: int = POST_CALL_WORKERS):
+        super().__init__(filename, "post-call", workers)
+    
+    def create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS post_call_jobs (
+                call_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                status TEXT NOT NULL DEFAULT 'watching',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                error TEXT
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS post_call_jobs_watching ON post_call_jobs (status, next_at)")
+    
+    def watch(self, call_id: str, user_id: Optional[str]):
+        """Start watching a newly placed call"""
+        if not call_id or not self.conn:
+            return
+        now = time.time()
+        with self.wakeup:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO post_call_jobs (call_id, user_id, next_at, created_at) VALUES (?, ?, ?, ?)",
+                (call_id, user_id, now + POST_CALL_FIRST_CHECK, now)
+            )
+            self._push(call_id, now + POST_CALL_FIRST_CHECK)
+    
+    def expedite(self, call_id: str) -> bool:
+        """Run a watched call's job now (e.g. Bland.ai reported it finished)"""
+        if not self.conn:
+            return False
+        now = time.time()
+        with self.wakeup:
+            updated = self.conn.execute(
+                "UPDATE post_call_jobs SET next_at = ? WHERE call_id = ? AND status = 'watching'",
+                (now, call_id)
+            ).rowcount > 0
+            if updated:
+                self._push(call_id, now)
+        return updated
+    
+    def process(self, call_id: str):
+        with self.lock:
+            user_id, attempts, created_at = self.conn.execute(
+                "SELECT user_id, attempts, created_at FROM post_call_jobs WHERE call_id = ?",
+                (call_id,)
+            ).fetchone()
+        
         try:
-            # Save to Supabase
-            chat_data = {
-                "user_id": user_id,
-                "message": message,
-                "timestamp": datetime.now().isoformat()
-            }
-            result = supabase.table("chat_history").insert(chat_data).execute()
-            return {"status": "success", "id": result.data[0]["id"] if result.data else None}
+            details = fetch_call_details(call_id)
+            if not call_is_complete(details):
+                if time.time() - created_at > POST_CALL_WATCH_LIMIT:
+                    self._finish(call_id, "abandoned", "Call did not finish while being watched")
+                else:
+                    self._reschedule(call_id, POST_CALL_POLL_INTERVAL, attempts)
+                return
+            
+            call_details_cache.put(call_id, details)
+            # Fetches from Bland.ai, tries /correct, punctuates, aligns speakers and persists
+            transcript = load_transcript(call_id, user_id)
+            if user_id and transcript.segments and not transcript.saved_for:
+                raise RuntimeError("Transcript could not be saved")
+            recording_url = fetch_recording_url(call_id)
+            if recording_url:
+                call_recording_cache.put(call_id, recording_url)
+            update_call_record(call_id, user_id, details, recording_url)
+            succeeded = call_succeeded(finished_call_status(details))
+            if succeeded is not None:
+                call_analytics.record_call_outcome(call_id, user_id, succeeded, call_duration_seconds(details))
+            self._finish(call_id, "done")
+        except UpstreamBusy:
+            # Saturation isn't a failure of this call - try again without using up an attempt
+            self._reschedule(call_id, POST_CALL_POLL_INTERVAL, attempts)
         except Exception as e:
-            print(f"Error saving chat to Supabase: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error saving chat history: {str(e)}")
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            print(f"Error precomputing call {call_id}: {detail}")
+            if attempts + 1 >= POST_CALL_MAX_ATTEMPTS:
+                self._finish(call_id, "failed", detail)
+            else:
+                self._reschedule(call_id, POST_CALL_POLL_INTERVAL * 2 ** attempts, attempts + 1, detail)
     
-    raise HTTPException(status_code=500, detail="Supabase client not initialized")
+    def _reschedule(self, call_id: str, delay: float, attempts: int, error: Optional[str] = None):
+        next_at = time.time() + delay
+        with self.wakeup:
+            self.conn.execute(
+                "UPDATE post_call_jobs SET next_at = ?, attempts = ?, error = ? WHERE call_id = ?",
+                (next_at, attempts, error, call_id)
+            )
+            self._requeue(call_id, next_at)
+    
+    def _finish(self, call_id: str, status: str, error: Optional[str] = None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE post_call_jobs SET status = ?, error = ? WHERE call_id = ?",
+                (status, error, call_id)
+            )
+            self.in_flight.discard(call_id)
 
-@app.get("/api/chat_history/{user_id}")
-def get_chat_history(user_id: str):
-    """Get chat history for a user"""
-    if supabase:
+post_call_pipeline = PostCallPipeline()
+
+@app.on_event("startup")
+def start_post_call_pipeline():
+    post_call_pipeline.start()
+
+@app.on_event("shutdown")
+def stop_post_call_pipeline():
+    post_call_pipeline.stop()
+
+@app.post("/api/webhooks/bland")
+async def bland_webhook(request: Request):
+    """Bland.ai call-completion webhook - only speeds up calls we are already watching"""
+    body = await request.json()
+    call_id = body.get("call_id")
+    if call_id and call_is_complete(body):
+        post_call_pipeline.expedite(call_id)
+    return {"status": "ok"}
+
+# --- Topic summarization ---
+# Extractive and local, so it needs no network; runs after the call is placed and
+# backfills call_history.summary. Results are cached by topic hash.
+SUMMARY_MAX_CHARS = 120
+SUMMARY_MAX_SENTENCES = 2
+SUMMARY_WORKERS = 2
+SUMMARY_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from", "have", "he", "her",
+    "him", "his", "how", "i", "if", "in", "is", "it", "its", "me", "my", "of", "on", "or", "our", "she",
+    "so", "that", "the", "their", "them", "they", "this", "to", "us", "was", "we", "what", "when", "will",
+    "with", "you", "your", "about", "please", "call", "tell", "ask", "want", "would", "like", "just"
+}
+
+def extractive_summary(text: str) -> str:
+    """Pick the sentences whose words recur most in the topic, up to SUMMARY_MAX_CHARS"""
+    text = " ".join(text.split())
+    if len(text) <= SUMMARY_MAX_CHARS:
+        return text
+    
+    sentences = [sentence for sentence in re.split(r'(?<=[.!?])\s+', text) if sentence]
+    sentence_words = [[word for word in search_tokens(sentence) if word not in SUMMARY_STOPWORDS] for sentence in sentences]
+    frequency = Counter(word for words in sentence_words for word in words)
+    top_frequency = max(frequency.values(), default=1)
+    
+    def score(i: int) -> float:
+        words = sentence_words[i]
+        if not words:
+            return 0.0
+        # Average normalized word frequency, with a nudge toward the opening sentence
+        return sum(frequency[word] / top_frequency for word in words) / len(words) + (0.2 if i == 0 else 0.0)
+    
+    chosen = []
+    length = 0
+    for i in sorted(range(len(sentences)), key=score, reverse=True):
+        if len(chosen) == SUMMARY_MAX_SENTENCES:
+            break
+        if length + len(sentences[i]) + 1 <= SUMMARY_MAX_CHARS:
+            chosen.append(i)
+            length += len(sentences[i]) + 1
+    if chosen:
+        return " ".join(sentences[i] for i in sorted(chosen))
+    
+    # Even the best sentence is too long - cut it at a word boundary
+    best = sentences[max(range(len(sentences)), key=score)]
+    return best[:SUMMARY_MAX_CHARS - 1].rsplit(" ", 1)[0].rstrip(",;:") + "…"
+
+class TopicSummarizer:
+    """Summaries cached by topic hash, in memory and in SQLite"""
+    
+    def __init__(self, filename: str = "topic_summaries.db"):
+        self.filename = filename
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.memory = LRUCache(POST_CALL_CACHE_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary")
+    
+    def start(self):
+        self.conn = open_local_db(self.filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS topic_summaries (topic_hash TEXT PRIMARY KEY, summary TEXT NOT NULL)")
+    
+    def topic_hash(self, topic: str) -> str:
+        return hashlib.sha256(" ".join(topic.lower().split()).encode("utf-8")).hexdigest()
+    
+    def cached(self, topic: str) -> Optional[str]:
+        key = self.topic_hash(topic)
+        summary = self.memory.get(key)
+        if summary is None and self.conn:
+            with self.lock:
+                row = self.conn.execute("SELECT summary FROM topic_summaries WHERE topic_hash = ?", (key,)).fetchone()
+            if row:
+                summary = row[0]
+                self.memory.put(key, summary)
+        return summary
+    
+    def summarize(self, topic: str) -> str:
+        summary = self.cached(topic)
+        if summary is None:
+            summary = extractive_summary(topic)
+            key = self.topic_hash(topic)
+            self.memory.put(key, summary)
+            if self.conn:
+                with self.lock:
+                    self.conn.execute("INSERT OR REPLACE INTO topic_summaries (topic_hash, summary) VALUES (?, ?)", (key, summary))
+        return summary
+    
+    def backfill(self, call_id: str, user_id: Optional[str], phone_number: str, topic: str):
+        """Summarize in the background, then fill in the call's summary"""
+        self.executor.submit(self._backfill, call_id, user_id, phone_number, topic)
+    
+    def _backfill(self, call_id: str, user_id: Optional[str], phone_number: str, topic: str):
+        try:
+            summary = self.summarize(topic)
+        except Exception as e:
+            print(f"Error summarizing topic: {str(e)}")
+            return
+        
+        for call in call_history.get(phone_number, []):
+            if call.get("call_id") == call_id:
+                call["summary"] = summary
+        
+        if supabase and user_id:
+            try:
+                supabase.table("call_history").update({"summary": summary}).eq("call_id", call_id).execute()
+            except Exception as e:
+                print(f"Error saving summary to Supabase: {str(e)}")
+
+topic_summarizer = TopicSummarizer()
+
+@app.on_event("startup")
+def start_topic_summarizer():
+    topic_summarizer.start()
+
+@app.post("/api/summarize_topic")
+async def summarize_topic(request: Request):
+    body = await request.json()
+    topic = body.get("topic", "")
+    return {"summary": topic_summarizer.summarize(topic)}
+
+# --- Chat history ---
+CHAT_LOG_DIR = os.path.join(DATA_DIR, "chat")
+CHAT_SEGMENT_SIZE = 16 * 1024 * 1024  # bytes per log segment
+CHAT_SYNC_INTERVAL = 2  # seconds between bulk syncs to Supabase
+CHAT_SYNC_BATCH = 500
+# Postgres data exceptions and constraint violations (bad user_id, deleted user) fail the same way on every retry
+CHAT_SYNC_REJECTED_CODES = ("22", "23")
+
+def chat_sync_rejected(e: Exception) -> bool:
+    """Whether Supabase rejected a record for good, as opposed to a transient failure"""
+    return str(getattr(e, "code", None) or "")[:2] in CHAT_SYNC_REJECTED_CODES
+CHAT_HYDRATE_RETRY = 60  # seconds before retrying a failed Supabase load
+
+class ChatLog:
+    """Append-only, segmented local log of chat messages.
+    
+    Each record is a (length, crc32) header followed by a JSON payload, written
+    to numbered segment files that roll over at CHAT_SEGMENT_SIZE. An in-memory
+    index maps each user to the (timestamp, segment, offset, length) of their
+    records, rebuilt by scanning the segments at startup; reads go through
+    mmap so recent chat is served without touching Supabase. A torn record at
+    the tail of the last segment (crash mid-write) is truncated away.
+    
+    Messages are synced to Supabase in bulk by a background thread. The sync
+    position is checkpointed to disk and inserts are upserts keyed on the
+    message id, so a crash between insert and checkpoint never duplicates rows.
+    If a batch fails, its records are retried one at a time; records Supabase
+    rejects outright are set aside in dead_letters.jsonl so they can't hold
+    back everyone else's messages.
+    """
+    
+    HEADER = struct.Struct("<II")
+    
+    def __init__(self, directory: str = CHAT_LOG_DIR, segment_size: int = CHAT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.index: Dict[str, List[tuple]] = {}
+        self.hydrated: set = set()
+        self.hydrate_lock = threading.Lock()
+        self.hydrate_failed: Dict[str, float] = {}
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.segment = 0
+        self.file = None
+        self.sync_wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.running = False
+    
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}.log")
+    
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for segment in segments:
+            self._scan(segment)
+        self.segment = segments[-1] if segments else 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        
+        self.running = True
+        self.thread = threading.Thread(target=self._sync_loop, name="chat-sync", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.sync_wakeup.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+    
+    def _scan(self, segment: int):
+        path = self.segment_path(segment)
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, crc = self.HEADER.unpack_from(data, offset)
+            payload = data[offset + self.HEADER.size:offset + self.HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self._index_record(json.loads(payload), segment, offset, self.HEADER.size + length)
+            offset += self.HEADER.size + length
+        if offset < len(data):
+            print(f"Truncating {len(data) - offset} bytes of torn chat log record in {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+    
+    def _index_record(self, record: dict, segment: int, offset: int, length: int):
+        if record.get("type") == "hydrated":
+            self.hydrated.add(record["user_id"])
+        else:
+            self.index.setdefault(record["user_id"], []).append((record["timestamp"], segment, offset, length))
+    
+    def append(self, records: List[dict]):
+        """Durably append records (one fsync per call) and index them"""
+        with self.lock:
+            for record in records:
+                payload = json.dumps(record, separators=(",", ":")).encode("utf-8")
+                if self.file.tell() > 0 and self.file.tell() + self.HEADER.size + len(payload) > self.segment_size:
+                    self._roll()
+                offset = self.file.tell()
+                self.file.write(self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                self._index_record(record, self.segment, offset, self.HEADER.size + len(payload))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    
+    def _roll(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+    
+    def _mapped(self, segment: int, end: int) -> mmap.mmap:
+        data = self.maps.get(segment)
+        if data is None or end > len(data):
+            # Map (or remap, for the growing active segment) the whole file
+            if data is not None:
+                data.close()
+            with open(self.segment_path(segment), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = data
+        return data
+    
+    def _read(self, segment: int, offset: int, length: int) -> dict:
+        return json.loads(self._mapped(segment, offset + length)[offset + self.HEADER.size:offset + length])
+    
+    def messages(self, user_id: str, limit: Optional[int] = None) -> List[dict]:
+        """A user's messages, newest first"""
+        with self.lock:
+            entries = sorted(self.index.get(user_id, []), reverse=True)[:limit]
+            records = [self._read(segment, offset, length) for _, segment, offset, length in entries]
+        return [{key: value for key, value in record.items() if key != "synced"} for record in records]
+    
+    def add_message(self, user_id: str, message: str) -> dict:
+        record = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "message": message,
+            "timestamp": datetime.now().isoformat()
+        }
+        self.append([record])
+        if supabase:
+            self.sync_wakeup.set()
+        return record
+    
+    def hydrate(self, user_id: str):
+        """Copy a user's older messages from Supabase into the log, once"""
+        if not supabase or user_id in self.hydrated:
+            return
+        with self.hydrate_lock:
+            if user_id not in self.hydrated:
+                self._hydrate(user_id)
+    
+    def _hydrate(self, user_id: str):
+        if time.time() - self.hydrate_failed.get(user_id, 0) < CHAT_HYDRATE_RETRY:
+            return
         try:
             response = supabase.table("chat_history")\
                 .select("*")\
                 .eq("user_id", user_id)\
-                .order("timestamp", desc=True)\
                 .execute()
-            return response.data
         except Exception as e:
             print(f"Error retrieving chat history from Supabase: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Error retrieving chat history: {str(e)}")
+            self.hydrate_failed[user_id] = time.time()
+            return
+        
+        known = {record["id"] for record in self.messages(user_id)}
+        records = [
+            {"id": row["id"], "user_id": user_id, "message": row["message"], "timestamp": row["timestamp"], "synced": True}
+            for row in response.data or [] if row["id"] not in known
+        ]
+        records.append({"type": "hydrated", "user_id": user_id})
+        self.append(records)
+        bump_version(f"chat:{user_id}")
+    
+    def _load_checkpoint(self) -> tuple:
+        try:
+            with open(os.path.join(self.directory, "sync_position.json")) as f:
+                position = json.load(f)
+            return position["segment"], position["offset"]
+        except (OSError, ValueError, KeyError):
+            return 1, 0
+    
+    def _save_checkpoint(self, segment: int, offset: int):
+        path = os.path.join(self.directory, "sync_position.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
     
-    raise HTTPException(status_code=500, detail="Supabase client not initialized")
+    def _unsynced(self, segment: int, offset: int):
+        """Message records after the checkpoint, and the position just past the last one read"""
+        records = []
+        with self.lock:
+            while segment <= self.segment and len(records) < CHAT_SYNC_BATCH:
+                end = self.file.tell() if segment == self.segment else os.path.getsize(self.segment_path(segment))
+                while offset < end and len(records) < CHAT_SYNC_BATCH:
+                    header = self._read_header(segment, offset)
+                    length = self.HEADER.size + header[0]
+                    record = self._read(segment, offset, length)
+                    if record.get("type") != "hydrated" and not record.get("synced"):
+                        records.append(record)
+                    offset += length
+                if offset >= end and segment < self.segment:
+                    segment, offset = segment + 1, 0
+                else:
+                    break
+        return records, segment, offset
+    
+    def _read_header(self, segment: int, offset: int) -> tuple:
+        return self.HEADER.unpack_from(self._mapped(segment, offset + self.HEADER.size), offset)
+    
+    def _sync_loop(self):
+        segment, offset = self._load_checkpoint()
+        while self.running:
+            self.sync_wakeup.wait(CHAT_SYNC_INTERVAL)
+            self.sync_wakeup.clear()
+            if not supabase:
+                continue
+            while True:
+                records, next_segment, next_offset = self._unsynced(segment, offset)
+                if (next_segment, next_offset) == (segment, offset):
+                    break
+                try:
+                    if records:
+                        supabase.table("chat_history").upsert(records).execute()
+                except Exception as e:
+                    print(f"Error syncing chat history to Supabase: {str(e)}")
+                    if not self._sync_each(records):
+                        break
+                segment, offset = next_segment, next_offset
+                self._save_checkpoint(segment, offset)
+    
+    def _sync_each(self, records: List[dict]) -> bool:
+        """Upsert records one at a time, dead-lettering rejected ones; False on a transient failure"""
+        for record in records:
+            try:
+                supabase.table("chat_history").upsert(record).execute()
+            except Exception as e:
+                if not chat_sync_rejected(e):
+                    return False
+                print(f"Chat message {record['id']} rejected by Supabase, moved to dead letters: {str(e)}")
+                self._dead_letter(record, str(e))
+        return True
+    
+    def _dead_letter(self, record: dict, error: str):
+        with open(os.path.join(self.directory, "dead_letters.jsonl"), "a") as f:
+            f.write(json.dumps({"record": record, "error": error, "at": datetime.now().isoformat()}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
 
-# Name verification endpoint using Gemini API
-@app.post("/api/verify-name")
-async def verify_name(req: NameVerificationRequest):
-    # Get the name and clean it up
-    name = req.name.strip()
+chat_log = ChatLog()
+
+@app.on_event("startup")
+def start_chat_log():
+    chat_log.start()
+
+@app.on_event("shutdown")
+def stop_chat_log():
+    chat_log.stop()
+
+@app.post("/api/chat_history")
+def save_chat(req: ChatMessageRequest):
+    """Save chat message to history"""
+    user_id = req.user_id
+    message = req.message
     
-    # SUPER SIMPLE VALIDATION - only reject empty names or pure nonsense
+    if not user_id or not message:
+        raise HTTPException(status_code=400, detail="User ID and message are required")
     
-    # Empty name check
-    if not name:
-        return {"isValidName": False, "reason": "Name cannot be empty"}
+    # Written to the local log, which syncs to Supabase in the background
+    record = chat_log.add_message(user_id, message)
+    bump_version(f"chat:{user_id}")
+    return {"status": "success", "id": record["id"]}
+
+@app.get("/api/chat_history/{user_id}")
+def get_chat_history(user_id: str, limit: Optional[int] = None):
+    """Get chat history for a user"""
+    chat_log.hydrate(user_id)
+    return chat_log.messages(user_id, limit)
+
+# --- Name validation ---
+NAME_LIST_FILE = os.getenv("NAME_LIST_FILE")
+PROFANITY_LIST_FILE = os.getenv("PROFANITY_LIST_FILE")
+MAX_NAMES_PER_BULK = 10000
+
+DEFAULT_COMMON_NAMES = ['dennis', 'john', 'mary', 'james', 'patricia', 'robert', 'jennifer', 'michael', 'linda', 
+                        'william', 'elizabeth', 'david', 'barbara', 'richard', 'susan', 'joseph', 'jessica', 
+                        'thomas', 'sarah', 'chris', 'karen', 'daniel', 'nancy', 'matthew', 'lisa', 'anthony', 
+                        'betty', 'mark', 'dorothy', 'donald', 'sandra', 'steve', 'ashley', 'paul', 'kimberly', 
+                        'andrew', 'donna', 'joshua', 'emily', 'kenneth', 'carol', 'kevin', 'michelle', 'brian']
+DEFAULT_PROFANITY = ['fuck', 'shit', 'ass', 'bitch', 'dick', 'pussy', 'cunt']
+KEYBOARD_SEQUENCES = ['asdfg', 'qwerty', 'zxcvbn']
+REJECTED_NAMES = {'adsfdsfsdf'}
+
+class NameValidator:
+    """Name checks compiled once from the word lists.
     
-    # Too short check
-    if len(name) < 2:
-        return {"isValidName": False, "reason": "Name is too short"}
-        
-    # Too long check
-    if len(name) > 50:
-        return {"isValidName": False, "reason": "Name is too long"}
+    Every list is merged into one Aho-Corasick automaton whose states carry a
+    bitmask of the lists that end there, so a single pass over the name finds
+    every common name, profanity and keyboard sequence it contains. Whether the
+    name is itself part of a common name ("jo" in "john") is answered by binary
+    search over the sorted suffixes of all common names. Neither check scans
+    the lists, so cost per name stays flat as they grow.
+    """
     
-    # Must contain at least one letter
-    if not any(c.isalpha() for c in name):
-        return {"isValidName": False, "reason": "Name must contain at least one letter"}
+    COMMON_NAME = 1
+    PROFANITY = 2
+    KEYBOARD = 4
     
-    # WHITELIST APPROACH: Immediately accept common names
-    # We explicitly check for "Dennis" first to ensure it works
-    name_lower = name.lower()
-    if "dennis" in name_lower:
-        return {"isValidName": True, "reason": "Name accepted"}
-        
-    # Common names list
-    common_names = ['john', 'mary', 'james', 'patricia', 'robert', 'jennifer', 'michael', 'linda', 
-                  'william', 'elizabeth', 'david', 'barbara', 'richard', 'susan', 'joseph', 'jessica', 
-                  'thomas', 'sarah', 'chris', 'karen', 'daniel', 'nancy', 'matthew', 'lisa', 'anthony', 
-                  'betty', 'mark', 'dorothy', 'donald', 'sandra', 'steve', 'ashley', 'paul', 'kimberly', 
-                  'andrew', 'donna', 'joshua', 'emily', 'kenneth', 'carol', 'kevin', 'michelle', 'brian']
+    def __init__(self, common_names: List[str], profanity: List[str], keyboard_sequences: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.mask: List[int] = [0]
+        for words, flag in ((common_names, self.COMMON_NAME), (profanity, self.PROFANITY), (keyboard_sequences, self.KEYBOARD)):
+            for word in words:
+                self._insert(word, flag)
+        self._link()
+        self._index_suffixes(common_names)
     
-    # Check for exact matches first
-    for common_name in common_names:
-        if common_name in name_lower or name_lower in common_name:
-            return {"isValidName": True, "reason": "Name accepted"}
+    @classmethod
+    def from_files(cls, name_file: Optional[str] = None, profanity_file: Optional[str] = None) -> "NameValidator":
+        """Build from one-entry-per-line files, falling back to the built-in lists"""
+        return cls(
+            load_word_list(name_file, DEFAULT_COMMON_NAMES),
+            load_word_list(profanity_file, DEFAULT_PROFANITY),
+            KEYBOARD_SEQUENCES
+        )
     
-    # BLACKLIST APPROACH: Only reject obviously bad inputs
+    def _insert(self, word: str, flag: int):
+        state = 0
+        for char in word:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.mask.append(0)
+            state = next_state
+        self.mask[state] |= flag
     
-    # Profanity check
-    profanity = ['fuck', 'shit', 'ass', 'bitch', 'dick', 'pussy', 'cunt']
-    if any(word in name_lower for word in profanity):
-        return {"isValidName": False, "reason": "Please enter an appropriate name"}
+    def _link(self):
+        # Breadth-first so each state's fail target is finished before its children
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.mask[child] |= self.mask[self.fail[child]]
+                queue.append(child)
     
-    # Only catch extremely obvious keyboard mashing
-    keyboard_sequences = ['asdfg', 'qwerty', 'zxcvbn']
-    if any(seq in name_lower for seq in keyboard_sequences):
-        return {"isValidName": False, "reason": "Please enter a real name"}
+    def _index_suffixes(self, words: List[str]):
+        # Every distinct suffix of every common name, sorted; names share most of their suffixes
+        self.suffixes = sorted({word[i:] for word in words for i in range(len(word))})
     
-    # Check for completely random strings - extremely lax
-    if name_lower == 'adsfdsfsdf':
-        return {"isValidName": False, "reason": "Please enter a real name"}
+    def scan(self, text: str) -> int:
+        """Bitmask of every list with an entry that occurs in text"""
+        state = 0
+        found = 0
+        goto = self.goto
+        fail = self.fail
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found |= self.mask[state]
+        return found
+    
+    def is_part_of_common_name(self, text: str) -> bool:
+        # Suffixes starting with text sort together, right where text would be inserted
+        i = bisect.bisect_left(self.suffixes, text)
+        return i < len(self.suffixes) and self.suffixes[i].startswith(text)
+    
+    def validate(self, name: str) -> dict:
+        # Get the name and clean it up
+        name = name.strip()
         
-    # FINAL DECISION: Accept almost everything else that isn't caught by the checks above
-    # This is more permissive to ensure real names aren't wrongly rejected
-    return {"isValidName": True, "reason": "Name accepted"}
+        # SUPER SIMPLE VALIDATION - only reject empty names or pure nonsense
         
-    try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
-        headers = {"Content-Type": "application/json"}
+        # Empty name check
+        if not name:
+            return {"isValidName": False, "reason": "Name cannot be empty"}
         
-        prompt = f"""
-        Determine if the following text is a valid human name:
-        "{name}"
+        # Too short check
+        if len(name) < 2:
+            return {"isValidName": False, "reason": "Name is too short"}
+            
+        # Too long check
+        if len(name) > 50:
+            return {"isValidName": False, "reason": "Name is too long"}
         
-        Respond in exactly this format:
-        {{
-  "isValidName": true/false,
-  "reason": "<brief explanation>"
-}}
-        
-        Set isValidName to true ONLY if it appears to be a real human name (first name, last name, or full name).
-        Set isValidName to false if it:
-        - Contains random characters (like "sadfsdfssdfdsasdf")
-        - Contains inappropriate content
-        - Is not a plausible human name
-        - Contains too many numbers or special characters
-        - Is a keyboard mashing or random string of letters
-        
-        BE STRICT - only accept strings that look like actual names a person would have.
-        """
+        # Must contain at least one letter
+        if not any(c.isalpha() for c in name):
+            return {"isValidName": False, "reason": "Name must contain at least one letter"}
         
-        data = {
-            "contents": [
-                {"role": "user", "parts": [{"text": prompt}]}
-            ]
-        }
-        response = requests.post(url, headers=headers, json=data, timeout=5)  # Add timeout
-        if response.status_code != 200:
-            # Use our fallback heuristic if API fails
-            unique_chars = len(set(name.lower()))
-            if unique_chars / len(name) > 0.7 and len(name) > 8:
-                return {"isValidName": False, "reason": "Name appears to be random characters"}
-            return {"isValidName": True, "reason": "API validation failed, basic check passed"}
+        name_lower = name.lower()
+        found = self.scan(name_lower)
         
-        result = response.json()
-        # Extract the response from Gemini
-        import re, json as pyjson
-        match = re.search(r'\{.*\}', result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', ''))
-        if match:
-            try:
-                verification = pyjson.loads(match.group(0))
-                return verification
-            except Exception:
-                # Fallback to heuristic
-                unique_chars = len(set(name.lower()))
-                if unique_chars / len(name) > 0.7 and len(name) > 8:
-                    return {"isValidName": False, "reason": "Name appears to be random characters"}
-                return {"isValidName": True, "reason": "JSON parsing failed, basic check passed"}
-        
-        # Fallback if regex doesn't match
-        unique_chars = len(set(name.lower()))
-        if unique_chars / len(name) > 0.7 and len(name) > 8:
-            return {"isValidName": False, "reason": "Name appears to be random characters"}
-        return {"isValidName": True, "reason": "Regex match failed, basic check passed"}
-    except Exception as e:
-        # Fallback to heuristic in case of any exception
-        unique_chars = len(set(name.lower()))
-        if unique_chars / len(name) > 0.7 and len(name) > 8:
-            return {"isValidName": False, "reason": "Name appears to be random characters"}
-        return {"isValidName": True, "reason": f"Exception occurred, basic check passed: {str(e)}"}
+        # WHITELIST APPROACH: Immediately accept common names
+        if found & self.COMMON_NAME or self.is_part_of_common_name(name_lower):
+            return {"isValidName": True, "reason": "Name accepted"}
+        
+        # BLACKLIST APPROACH: Only reject obviously bad inputs
+        if found & self.PROFANITY:
+            return {"isValidName": False, "reason": "Please enter an appropriate name"}
+        
+        # Only catch extremely obvious keyboard mashing
+        if found & self.KEYBOARD or name_lower in REJECTED_NAMES:
+            return {"isValidName": False, "reason": "Please enter a real name"}
+            
+        # FINAL DECISION: Accept almost everything else that isn't caught by the checks above
+        # This is more permissive to ensure real names aren't wrongly rejected
+        return {"isValidName": True, "reason": "Name accepted"}
+
+def load_word_list(path: Optional[str], default: List[str]) -> List[str]:
+    """Read lowercase entries from a file with one entry per line, skipping blanks and # comments"""
+    if not path:
+        return default
+    try:
+        with open(path, encoding="utf-8") as f:
+            words = {line.strip().lower() for line in f}
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"Error loading word list {path}, using the built-in list: {str(e)}")
+        return default
+    return sorted(word for word in words if word and not word.startswith("#"))
+
+# Built-in lists until startup loads the configured ones
+name_validator = NameValidator(DEFAULT_COMMON_NAMES, DEFAULT_PROFANITY, KEYBOARD_SEQUENCES)
+
+@app.on_event("startup")
+def load_name_validator():
+    global name_validator
+    name_validator = NameValidator.from_files(NAME_LIST_FILE, PROFANITY_LIST_FILE)
+
+@app.post("/api/verify-name")
+async def verify_name(req: NameVerificationRequest):
+    return name_validator.validate(req.name)
+
+@app.post("/api/verify-names")
+def verify_names(req: BulkNameVerificationRequest):
+    """Validate many names at once, e.g. for onboarding imports"""
+    if len(req.names) > MAX_NAMES_PER_BULK:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_NAMES_PER_BULK} names per request")
+    return {"results": [{"name": name, **name_validator.validate(name)} for name in req.names]}
 
 # New endpoint for getting corrected transcripts using Bland.ai's corrected transcript API
 @app.get("/api/call_corrected_transcript/{call_id}")
-def get_call_corrected_transcript(call_id: str, user_id: Optional[str] = None):
+def get_call_corrected_transcript(call_id: str, user_id: Optional[str] = None, cursor: Optional[str] = None):
     """Get corrected call transcript for a specific call"""
     if not BLAND_API_KEY:
         raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
     
-    # First try Supabase for stored transcript
-    if supabase and user_id:
-        try:
-            response = supabase.table("call_transcript")\
-                .select("*")\
-                .eq("call_id", call_id)\
-                .single()\
-                .execute()
-                
-            if response.data:
-                return {
-                    "status": "success", 
-                    "transcript": response.data.get("transcript"),
-                    "aligned": json.loads(response.data.get("aligned_transcript")) if response.data.get("aligned_transcript") else None
-                }
-        except Exception as e:
-            print(f"Error retrieving transcript from Supabase: {str(e)}")
-    
-    # Try to get corrected transcript first (better quality)
     try:
-        corrected_url = f"https://api.bland.ai/v1/calls/{call_id}/correct"
-        headers = {'Authorization': BLAND_API_KEY}
-        
-        corrected_resp = requests.get(corrected_url, headers=headers)
-        if corrected_resp.ok:
-            corrected_data = corrected_resp.json()
-            
-            # If we have corrected/aligned transcript data
-            if corrected_data.get("aligned"):
-                aligned = corrected_data.get("aligned")
-                concat_transcript = ""
-                
-                # Format transcript text
-                for segment in aligned:
-                    speaker = segment.get("speaker", "Unknown")
-                    text = segment.get("text", "").strip()
-                    if text:
-                        concat_transcript += f"{speaker}: {text}\n"
-                
-                # Save to Supabase if possible
-                if supabase and user_id:
-                    try:
-                        db_transcript = {
-                            "call_id": call_id,
-                            "user_id": user_id,
-                            "transcript": concat_transcript,
-                            "aligned_transcript": json.dumps(aligned)
-                        }
-                        supabase.table("call_transcript").upsert(db_transcript).execute()
-                    except Exception as e:
-                        print(f"Error saving corrected transcript to Supabase: {str(e)}")
-                
-                return {"status": "success", "transcript": concat_transcript, "aligned": aligned}
+        return transcript_response(load_transcript(call_id, user_id), cursor)
+    except UpstreamBusy:
+        raise
     except Exception as e:
-        print(f"Error getting corrected transcript: {str(e)}")
-        # Fall back to regular transcript below
+        raise HTTPException(status_code=500, detail=f"Error getting call transcript: {str(e)}")
+
+# --- SMS ---
+TEXTBELT_URL = "https://textbelt.com/text"
+TEXTBELT_QUOTA_URL = "https://textbelt.com/quota"
+MAX_SMS_PER_GUEST = 3
+MAX_SMS_PER_USER = 10
+MAX_SMS_PER_BULK = 500
+SMS_RATE_PER_SECOND = float(os.getenv("SMS_RATE_PER_SECOND", "1"))
+SMS_BURST = int(os.getenv("SMS_BURST", "5"))
+SMS_TIMEOUT = 10  # seconds per Textbelt request
+SMS_MAX_ATTEMPTS = 4
+SMS_SEND_WAIT = 0.5  # seconds /api/sms waits for delivery before answering 202 "queued"
+SMS_QUOTA_RESERVE = int(os.getenv("SMS_QUOTA_RESERVE", "0"))
+SMS_QUOTA_RECHECK = 300  # seconds between quota checks while paused
+
+class BulkSMSMessage(BaseModel):
+    phone_number: str
+    message: str
+
+class BulkSMSRequest(BaseModel):
+    messages: List[BulkSMSMessage]
+    admin: Optional[bool] = False
+    user_id: Optional[str] = None
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
     
-    # If corrected transcript fails, fall back to regular transcript
-    try:
-        # Get call details which includes transcript from Bland.ai
-        bland_url = f"https://api.bland.ai/v1/calls/{call_id}"
-        headers = {'Authorization': BLAND_API_KEY}
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def take(self) -> float:
+        """Take a token if one is available, otherwise return the seconds until one will be"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+class SMSTransientError(Exception):
+    """Textbelt failure worth retrying (timeouts, 429s and 5xx responses)"""
+
+class SMSDispatcher(DurableQueue):
+    """Durable SMS outbox sent to Textbelt by one background thread.
+    
+    Messages are stored in SQLite and queued in due-time order. The dispatcher
+    paces sends with a token bucket, retries transient failures with
+    exponential backoff, and tracks Textbelt's quotaRemaining so it pauses
+    before the quota runs out instead of burning requests on errors.
+    """
+    
+    table = "sms_history"
+    due_column = "created_at"
+    ready_status = "queued"
+    
+    def __init__(self, filename: str = "sms.db"):
+        super().__init__(filename, "sms-dispatcher")
+        self.bucket = TokenBucket(SMS_RATE_PER_SECOND, SMS_BURST)
+        self.quota_remaining: Optional[int] = None
+        self.paused_until = 0.0
+        self.waiters: Dict[str, threading.Event] = {}
+    
+    def create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sms_history (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                phone_number TEXT NOT NULL,
+                message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                text_id TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                sent_at REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sms_history_phone ON sms_history (phone_number, status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sms_history_user ON sms_history (user_id, created_at)")
+    
+    def recover(self):
+        # A message mid-send during a crash may have been delivered - don't send it twice
+        self.conn.execute(
+            "UPDATE sms_history SET status = 'interrupted', error = 'Server restarted while sending' WHERE status = 'sending'"
+        )
+    
+    def quota_exhausted(self) -> bool:
+        return self.quota_remaining is not None and self.quota_remaining <= SMS_QUOTA_RESERVE
+    
+    def count_sent(self, phone_number: str) -> int:
+        """Count messages to a phone number that were sent or are still going to be"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM sms_history WHERE phone_number = ? AND status IN ('queued', 'sending', 'sent')",
+                (phone_number,)
+            ).fetchone()[0]
+    
+    def enqueue(self, phone_number: str, message: str, user_id: Optional[str]) -> str:
+        sms_id = str(uuid.uuid4())
+        now = time.time()
+        with self.wakeup:
+            self.conn.execute(
+                "INSERT INTO sms_history (id, user_id, phone_number, message, created_at) VALUES (?, ?, ?, ?, ?)",
+                (sms_id, user_id, phone_number, message, now)
+            )
+            self.waiters[sms_id] = threading.Event()
+            self._push(sms_id, now)
+        return sms_id
+    
+    def wait(self, sms_id: str, timeout: float) -> Optional[dict]:
+        """Wait for a message to be sent or to fail permanently"""
+        event = self.waiters.get(sms_id)
+        if event:
+            event.wait(timeout)
+        return self.get(sms_id)
+    
+    def get(self, sms_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, user_id, phone_number, message, status, attempts, text_id, error, created_at, sent_at FROM sms_history WHERE id = ?",
+                (sms_id,)
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+    
+    def list_for_user(self, user_id: str, limit: int = 100) -> List[dict]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, user_id, phone_number, message, status, attempts, text_id, error, created_at, sent_at FROM sms_history WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+    
+    def _row_to_dict(self, row) -> dict:
+        sms_id, user_id, phone_number, message, status, attempts, text_id, error, created_at, sent_at = row
+        return {
+            "id": sms_id,
+            "user_id": user_id,
+            "phone_number": phone_number,
+            "message": message,
+            "status": status,
+            "attempts": attempts,
+            "textId": text_id,
+            "error": error,
+            "timestamp": datetime.fromtimestamp(created_at, timezone.utc).isoformat(),
+            "sent_at": datetime.fromtimestamp(sent_at, timezone.utc).isoformat() if sent_at else None
+        }
+    
+    def ready_at(self) -> Optional[float]:
+        # Nothing is sent while paused for quota
+        return max(self.heap[0][0], self.paused_until) if self.heap else None
+    
+    def pace(self) -> bool:
+        # Pace to the provider rate limit before taking the message off the queue
+        delay = self.bucket.take()
+        if delay:
+            time.sleep(delay)
+            return False
+        return True
+    
+    def process(self, sms_id: str):
+        with self.lock:
+            self.in_flight.discard(sms_id)
+            row = self.conn.execute(
+                "SELECT phone_number, message, attempts FROM sms_history WHERE id = ? AND status = 'queued'",
+                (sms_id,)
+            ).fetchone()
+            if not row:
+                return
+            phone_number, message, attempts = row
+            self.conn.execute(
+                "UPDATE sms_history SET status = 'sending', attempts = ? WHERE id = ?",
+                (attempts + 1, sms_id)
+            )
         
-        resp = requests.get(bland_url, headers=headers)
-        if not resp.ok:
-            raise HTTPException(status_code=resp.status_code, detail=f"Failed to get call transcript: {resp.text}")
+        self._send(sms_id, phone_number, message, attempts + 1)
+    
+    def _send(self, sms_id: str, phone_number: str, message: str, attempt: int):
+        payload = {
+            'phone': phone_number,
+            'message': message,
+            'key': os.getenv("TEXT_KEY")
+        }
         
-        data = resp.json()
+        try:
+            with upstream_slot("textbelt"):
+                resp = requests.post(TEXTBELT_URL, json=payload, timeout=SMS_TIMEOUT)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                raise SMSTransientError(f"Textbelt returned HTTP {resp.status_code}")
+            data = resp.json()
+        except (requests.RequestException, ValueError, SMSTransientError, UpstreamBusy) as e:
+            if attempt < SMS_MAX_ATTEMPTS:
+                self._retry(sms_id, 2 ** attempt, str(e))
+            else:
+                self._finish(sms_id, "error", error=str(e))
+            return
         
-        # Check for transcript API v2 (aligned transcript)
-        if data.get("transcript_aligned"):
-            aligned = []
-            concat_transcript = ""
-            
-            for segment in data.get("transcript_aligned", []):
-                speaker = "Agent" if segment.get("from") == "ai" else "User"
-                text = segment.get("text", "").strip()
-                if text:
-                    aligned.append({"speaker": speaker, "text": text})
-                    concat_transcript += f"{speaker}: {text}\n"
-                    
-            # Save to Supabase if possible
-            if supabase and user_id:
-                try:
-                    db_transcript = {
-                        "call_id": data.get("call_id"),
-                        "user_id": user_id,
-                        "transcript": concat_transcript,
-                        "aligned_transcript": json.dumps(aligned)
-                    }
-                    supabase.table("call_transcript").insert(db_transcript).execute()
-                except Exception as e:
-                    print(f"Error saving transcript to Supabase: {str(e)}")
-            
-            return {"status": "success", "transcript": concat_transcript, "aligned": aligned}
-        
-        # Check for transcript field
-        elif data.get("transcript"):
-            transcript = data.get("transcript", "")
-            # IMPROVEMENT: Add punctuation and sentence segmentation
-            improved_transcript = improve_transcript_readability(transcript)
-            # Process transcript to create agent/user segments
-            try:
-                aligned = []
-                lines = improved_transcript.split("\n")
-                current_speaker = None
-                for idx, line in enumerate(lines):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    # Check for speaker change
-                    if line.startswith("AI:") or line.startswith("Agent:"):
-                        current_speaker = "Agent"
-                        text = line.split(":", 1)[1].strip()
-                        aligned.append({"speaker": current_speaker, "text": text})
-                    elif line.startswith("Human:") or line.startswith("User:"):
-                        current_speaker = "User"
-                        text = line.split(":", 1)[1].strip()
-                        aligned.append({"speaker": current_speaker, "text": text})
-                    else:
-                        # If transcript is a single block, alternate speakers every sentence
-                        if not aligned:
-                            current_speaker = "Agent"
-                            aligned.append({"speaker": current_speaker, "text": line})
-                        else:
-                            # Alternate speakers for each new sentence if no prefix
-                            current_speaker = "User" if aligned[-1]["speaker"] == "Agent" else "Agent"
-                            aligned.append({"speaker": current_speaker, "text": line})
-                if aligned:
-                    # Save to Supabase if possible
-                    if supabase and user_id:
-                        try:
-                            db_transcript = {
-                                "call_id": data.get("call_id"),
-                                "user_id": user_id,
-                                "transcript": improved_transcript,
-                                "aligned_transcript": json.dumps(aligned)
-                            }
-                            supabase.table("call_transcript").insert(db_transcript).execute()
-                        except Exception as e:
-                            print(f"Error saving transcript to Supabase: {str(e)}")
-                    
-                    return {"status": "success", "transcript": improved_transcript, "aligned": aligned}
-            except Exception as e:
-                print(f"Error processing concatenated transcript: {str(e)}")
-                
-        # Check if call is still in progress
-        if data.get("status") == "in-progress" or data.get("completed") is False:
-            return {"status": "pending", "message": "Call still in progress, transcript not available yet"}
-            
-        return {"status": "error", "message": "Transcript not available for this call"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting call transcript: {str(e)}")
+        if "quotaRemaining" in data:
+            self._update_quota(data.get("quotaRemaining"))
+        
+        if data.get("success"):
+            self._finish(sms_id, "sent", text_id=data.get("textId"))
+        else:
+            error = data.get("error") or "Unknown Textbelt error"
+            if "quota" in error.lower():
+                # Out of quota: hold this message and everything behind it until quota returns
+                self._update_quota(0)
+                self._retry(sms_id, 0, error)
+            else:
+                self._finish(sms_id, "error", error=error)
+    
+    def _retry(self, sms_id: str, delay: float, error: str):
+        with self.wakeup:
+            self.conn.execute("UPDATE sms_history SET status = 'queued', error = ? WHERE id = ?", (error, sms_id))
+            self._push(sms_id, time.time() + delay)
+    
+    def _finish(self, sms_id: str, status: str, text_id: Optional[str] = None, error: Optional[str] = None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE sms_history SET status = ?, text_id = ?, error = ?, sent_at = ? WHERE id = ?",
+                (status, text_id, error, time.time() if status == "sent" else None, sms_id)
+            )
+            row = self.conn.execute("SELECT user_id FROM sms_history WHERE id = ?", (sms_id,)).fetchone()
+            event = self.waiters.pop(sms_id, None)
+        if event:
+            event.set()
+        call_analytics.record_sms(sms_id, row[0] if row else None, status == "sent")
+    
+    def _update_quota(self, quota_remaining):
+        try:
+            self.quota_remaining = int(quota_remaining)
+        except (TypeError, ValueError):
+            return
+        with self.wakeup:
+            was_paused = self.paused_until > time.time()
+            self.paused_until = time.time() + SMS_QUOTA_RECHECK if self.quota_exhausted() else 0.0
+            self.wakeup.notify()
+        if self.quota_exhausted() and not was_paused:
+            print(f"Textbelt quota low ({self.quota_remaining} left), pausing SMS for {SMS_QUOTA_RECHECK}s")
+            timer = threading.Timer(SMS_QUOTA_RECHECK, self.refresh_quota)
+            timer.daemon = True
+            timer.start()
+    
+    def refresh_quota(self):
+        """Fetch the remaining quota from Textbelt without sending a message"""
+        key = os.getenv("TEXT_KEY")
+        if not key:
+            return
+        try:
+            with upstream_slot("textbelt"):
+                resp = requests.get(f"{TEXTBELT_QUOTA_URL}/{key}", timeout=SMS_TIMEOUT)
+            data = resp.json()
+            if data.get("success"):
+                self._update_quota(data.get("quotaRemaining"))
+        except Exception as e:
+            print(f"Error checking Textbelt quota: {str(e)}")
+
+sms_dispatcher = SMSDispatcher()
+
+@app.on_event("startup")
+def start_sms_dispatcher():
+    sms_dispatcher.start()
+    threading.Thread(target=sms_dispatcher.refresh_quota, daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_sms_dispatcher():
+    sms_dispatcher.stop()
+
+def check_sms_allowed(phone_number: str, user_id: Optional[str], is_admin: bool, count: int = 1) -> Optional[str]:
+    """Return a rejection message if sending `count` more messages would exceed a limit"""
+    if sms_dispatcher.quota_exhausted():
+        raise HTTPException(
+            status_code=503,
+            detail="SMS quota exhausted. Please try again later.",
+            headers={"Retry-After": str(SMS_QUOTA_RECHECK)}
+        )
+    if is_admin:
+        return None
+    
+    max_sms = MAX_SMS_PER_USER if user_id else MAX_SMS_PER_GUEST
+    if sms_dispatcher.count_sent(phone_number) + count > max_sms:
+        return f"You have reached the maximum number of SMS messages ({max_sms})."
+    return None
 
 @app.post("/api/sms")
-async def send_sms(req: SMSRequest):
+def send_sms(req: SMSRequest, response: Response):
+    """Send an SMS, or queue it (202) if it isn't delivered within SMS_SEND_WAIT; poll /api/sms/{id}"""
     if not os.getenv("TEXT_KEY"):
         raise HTTPException(status_code=500, detail="TEXT_KEY not set in environment.")
 
-    is_admin = req.admin
-    user_id = req.user_id
+    rejection = check_sms_allowed(req.phone_number, req.user_id, req.admin)
+    if rejection:
+        return {"message": rejection}
 
-    # Implement SMS limits (3 for guests, 10 for authenticated)
-    # NOTE: This in-memory history is not ideal for production, consider using a persistent store like Supabase
-    # For now, we'll use a simple counter per phone number for demonstration
-    phone_number = req.phone_number
-    message = req.message
+    sms_id = sms_dispatcher.enqueue(req.phone_number, req.message, req.user_id)
+    sms = sms_dispatcher.wait(sms_id, SMS_SEND_WAIT)
 
-    if not is_admin:
-        # This is a very basic limit implementation and needs improvement
-        # A proper implementation would track SMS sent per user/phone number over a time period
-        # For this example, we'll just use a simple counter tied to the phone number in memory
-        if phone_number not in call_history: # Reusing call_history for simplicity, ideally would have sms_history
-            call_history[phone_number] = []
+    if sms["status"] == "sent":
+        return {
+            "message": "SMS sent successfully!",
+            "success": True,
+            "quotaRemaining": sms_dispatcher.quota_remaining,
+            "textId": sms["textId"],
+            "id": sms_id
+        }
+    if sms["status"] == "error":
+        raise HTTPException(status_code=400, detail=f"Failed to send SMS: {sms['error']}")
+    
+    # Still waiting on the rate limit or a retry - the dispatcher will keep trying
+    response.status_code = 202
+    return {
+        "message": "SMS queued for delivery.",
+        "success": True,
+        "status": sms["status"],
+        "id": sms_id
+    }
 
-        # Count SMS sent (using a placeholder status "sms_sent")
-        sms_sent_count = len([item for item in call_history[phone_number] if item.get("type") == "sms"])
+@app.post("/api/sms/bulk")
+def send_bulk_sms(req: BulkSMSRequest):
+    """Queue many SMS messages at once; poll /api/sms/{id} for delivery status"""
+    if not os.getenv("TEXT_KEY"):
+        raise HTTPException(status_code=500, detail="TEXT_KEY not set in environment.")
+    if not req.messages:
+        raise HTTPException(status_code=400, detail="At least one message is required")
+    if len(req.messages) > MAX_SMS_PER_BULK:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SMS_PER_BULK} messages per request")
 
-        if user_id:
-            max_sms = 10
-        else:
-            max_sms = 3
-
-        if sms_sent_count >= max_sms:
-            return {"message": f"You have reached the maximum number of SMS messages ({max_sms})."}
-
-    textbelt_url = "https://textbelt.com/text"
-    headers = {'Content-Type': 'application/json'}
-    # Using data-urlencode as per documentation for POST data
-    payload = {
-        'phone': phone_number,
-        'message': message,
-        'key': os.getenv("TEXT_KEY")
-    }
+    per_phone: Dict[str, int] = {}
+    for item in req.messages:
+        per_phone[item.phone_number] = per_phone.get(item.phone_number, 0) + 1
+    for phone_number, count in per_phone.items():
+        rejection = check_sms_allowed(phone_number, req.user_id, req.admin, count)
+        if rejection:
+            return {"message": f"{phone_number}: {rejection}"}
 
-    try:
-        # Make the POST request to Textbelt
-        resp = requests.post(textbelt_url, json=payload)
-        data = resp.json()
+    ids = [sms_dispatcher.enqueue(item.phone_number, item.message, req.user_id) for item in req.messages]
+    return {"message": f"{len(ids)} SMS messages queued.", "success": True, "ids": ids}
 
-        if data.get("success"):
-            # Record successful SMS send (using a placeholder type "sms")
-            if phone_number not in call_history:
-                call_history[phone_number] = []
-            call_history[phone_number].append({
-                "type": "sms",
-                "status": "success",
-                "timestamp": datetime.now().isoformat(),
-                "phone_number": phone_number,
-                "message_id": data.get("textId") # Textbelt returns textId on success
-            })
-            # In a real app, you might save this to Supabase as well, similar to calls
+@app.get("/api/sms/{sms_id}")
+def get_sms_status(sms_id: str):
+    """Get delivery status for a queued SMS"""
+    sms = sms_dispatcher.get(sms_id)
+    if not sms:
+        raise HTTPException(status_code=404, detail="SMS not found")
+    return sms
 
-            return {
-                "message": "SMS sent successfully!",
-                "success": True,
-                "quotaRemaining": data.get("quotaRemaining"),
-                "textId": data.get("textId")
-            }
-        else:
-            # Record failed SMS send
-            if phone_number not in call_history:
-                call_history[phone_number] = []
-            call_history[phone_number].append({
-                "type": "sms",
-                "status": "error",
-                "timestamp": datetime.now().isoformat(),
-                "phone_number": phone_number,
-                "error": data.get("error")
-            })
-            # In a real app, you might save this to Supabase as well
+@app.get("/api/sms_history")
+def get_sms_history(user_id: Optional[str] = None):
+    """Get SMS history for a user"""
+    if not user_id:
+        return []
+    return sms_dispatcher.list_for_user(user_id)
 
-            raise HTTPException(status_code=400, detail=f"Failed to send SMS: {data.get('error')}")
+# --- Scheduled calls ---
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "4"))
+SCHEDULER_BUSY_RETRY = 15  # seconds before retrying a call whose upstream was saturated
 
-    except Exception as e:
-        # Record exception during SMS send
-        if phone_number not in call_history:
-            call_history[phone_number] = []
-        call_history[phone_number].append({
-            "type": "sms",
-            "status": "exception",
-            "timestamp": datetime.now().isoformat(),
-            "phone_number": phone_number,
-            "error": str(e)
+def parse_scheduled_time(value: str, tz_name: Optional[str] = None) -> float:
+    """Convert an ISO 8601 time (local to tz_name if it has no offset) to a UNIX timestamp"""
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="scheduled_time must be an ISO 8601 date and time")
+    
+    if when.tzinfo is None:
+        try:
+            when = when.replace(tzinfo=ZoneInfo(tz_name) if tz_name else timezone.utc)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise HTTPException(status_code=400, detail=f"Unknown timezone: {tz_name}")
+    return when.timestamp()
+
+class CallScheduler(DurableQueue):
+    """Durable queue of future calls, placed by a small worker pool when due.
+    
+    A worker claims a job (pending -> dispatching) in a committed write
+    immediately before placing its call, so due jobs still waiting for a worker
+    stay pending. Jobs marked dispatching at startup were being placed during a
+    crash and are marked interrupted rather than fired a second time.
+    """
+    
+    table = "scheduled_calls"
+    # Let calls being placed finish on shutdown
+    wait_on_stop = True
+    
+    def __init__(self, filename: str = "scheduled_calls.db", workers: int = SCHEDULER_WORKERS):
+        super().__init__(filename, "call-scheduler", workers)
+    
+    def create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS scheduled_calls (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                phone_number TEXT NOT NULL,
+                due_at REAL NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT,
+                created_at REAL NOT NULL,
+                fired_at REAL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scheduled_calls_pending ON scheduled_calls (status, due_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scheduled_calls_user ON scheduled_calls (user_id, due_at)")
+    
+    def recover(self):
+        # Jobs claimed before a crash may already have been placed - never fire them twice
+        self.conn.execute(
+            "UPDATE scheduled_calls SET status = 'interrupted', result = ? WHERE status = 'dispatching'",
+            (json.dumps({"message": "Server restarted while the call was being placed"}),)
+        )
+    
+    def start(self):
+        super().start()
+        print(f"Call scheduler started with {len(self.heap)} pending jobs")
+    
+    def schedule(self, req: CallRequest, due_at: float) -> dict:
+        job_id = str(uuid.uuid4())
+        payload = json.dumps({
+            "phone_number": req.phone_number,
+            "topic": req.topic,
+            "admin": req.admin,
+            "user_id": req.user_id
         })
-        # In a real app, you might save this to Supabase as well
+        with self.wakeup:
+            self.conn.execute(
+                "INSERT INTO scheduled_calls (id, user_id, phone_number, due_at, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, req.user_id, req.phone_number, due_at, payload, time.time())
+            )
+            self._push(job_id, due_at)
+        return self.get(job_id)
+    
+    def cancel(self, job_id: str, user_id: Optional[str]) -> bool:
+        # The heap entry is left behind and skipped when the dispatcher fails to claim it
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE scheduled_calls SET status = 'cancelled' WHERE id = ? AND user_id IS ? AND status = 'pending'",
+                (job_id, user_id)
+            )
+        return cursor.rowcount > 0
+    
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT id, user_id, phone_number, due_at, payload, status, result, created_at, fired_at FROM scheduled_calls WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+    
+    def list_for_user(self, user_id: str, limit: int = 100) -> List[dict]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, user_id, phone_number, due_at, payload, status, result, created_at, fired_at FROM scheduled_calls WHERE user_id = ? ORDER BY due_at DESC LIMIT ?",
+                (user_id, limit)
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+    
+    def _row_to_dict(self, row) -> dict:
+        job_id, user_id, phone_number, due_at, payload, status, result, created_at, fired_at = row
+        return {
+            "id": job_id,
+            "user_id": user_id,
+            "phone_number": phone_number,
+            "topic": json.loads(payload).get("topic"),
+            "scheduled_time": datetime.fromtimestamp(due_at, timezone.utc).isoformat(),
+            "status": status,
+            "result": json.loads(result) if result else None,
+            "created_at": datetime.fromtimestamp(created_at, timezone.utc).isoformat(),
+            "fired_at": datetime.fromtimestamp(fired_at, timezone.utc).isoformat() if fired_at else None
+        }
+    
+    def process(self, job_id: str):
+        with self.lock:
+            self.in_flight.discard(job_id)
+            # Claim right before placing the call; a cancel may have won in the meantime
+            claimed = self.conn.execute(
+                "UPDATE scheduled_calls SET status = 'dispatching', fired_at = ? WHERE id = ? AND status = 'pending'",
+                (time.time(), job_id)
+            ).rowcount > 0
+            if not claimed:
+                return
+            payload = self.conn.execute("SELECT payload FROM scheduled_calls WHERE id = ?", (job_id,)).fetchone()[0]
+        
+        try:
+            result = place_call(CallRequest(**json.loads(payload)))
+            # Moderation and call limit rejections come back as a message without a call_id
+            status = "completed" if result.get("call_id") else "rejected"
+        except UpstreamBusy:
+            # Nothing was sent upstream, so the call can safely be tried again shortly
+            due_at = time.time() + SCHEDULER_BUSY_RETRY
+            with self.wakeup:
+                self.conn.execute(
+                    "UPDATE scheduled_calls SET status = 'pending', due_at = ?, fired_at = NULL WHERE id = ?",
+                    (due_at, job_id)
+                )
+                self._push(job_id, due_at)
+            return
+        except HTTPException as e:
+            result = {"message": e.detail}
+            status = "failed"
+        except Exception as e:
+            result = {"message": f"Error placing scheduled call: {str(e)}"}
+            status = "failed"
+        
+        with self.lock:
+            self.conn.execute(
+                "UPDATE scheduled_calls SET status = ?, result = ? WHERE id = ?",
+                (status, json.dumps(result), job_id)
+            )
 
-        raise HTTPException(status_code=500, detail=f"Error sending SMS: {str(e)}")
+call_scheduler = CallScheduler()
 
-# --- Gemini summarization for call topics ---
-async def summarize_topic_internal(topic: str):
-    """Internal function for summarizing topics to avoid duplicating code"""
-    return {"summary": topic}
+@app.on_event("startup")
+def start_call_scheduler():
+    call_scheduler.start()
 
-@app.post("/api/summarize_topic")
-async def summarize_topic(request: Request):
-    body = await request.json()
-    topic = body.get("topic", "")
-    # Return the original topic without summarization
-    return {"summary": topic}
+@app.on_event("shutdown")
+def stop_call_scheduler():
+    call_scheduler.stop()
+
+@app.post("/api/scheduled_calls")
+def schedule_call(req: ScheduledCallRequest):
+    """Schedule a call to be placed at a future time"""
+    if not BLAND_API_KEY:
+        raise HTTPException(status_code=500, detail="BLAND_API_KEY not set in environment.")
+    
+    due_at = parse_scheduled_time(req.scheduled_time, req.timezone)
+    return call_scheduler.schedule(req, due_at)
+
+@app.get("/api/scheduled_calls")
+def get_scheduled_calls(user_id: Optional[str] = None):
+    """List scheduled calls for a user"""
+    if not user_id:
+        return []
+    return call_scheduler.list_for_user(user_id)
+
+@app.delete("/api/scheduled_calls/{job_id}")
+def cancel_scheduled_call(job_id: str, user_id: Optional[str] = None):
+    """Cancel a scheduled call that has not been placed yet"""
+    if not call_scheduler.cancel(job_id, user_id):
+        raise HTTPException(status_code=404, detail="Scheduled call not found or already placed")
+    return {"status": "success", "id": job_id}
+
+# --- Call analytics ---
+# Rollups are updated as calls and SMS happen, so reading them never scans call_history.
+# Each event is recorded once by id, which makes replays (restarts, webhook + poll,
+# seeding from existing history) safe.
+ANALYTICS_GLOBAL_SCOPE = "*"
+ANALYTICS_MAX_DAYS = 366
+SKETCH_RELATIVE_ACCURACY = 0.01
+# Counters kept per scope and day, in this order
+ANALYTICS_COUNTERS = ("calls", "completed", "failed", "sms_sent", "sms_failed")
+
+def analytics_day(timestamp: Optional[str] = None) -> str:
+    # call_history.call_time is a local ISO timestamp; days use the same clock
+    return (timestamp or datetime.now().isoformat())[:10]
+
+class DurationSketch:
+    """DDSketch-style quantile sketch over call durations.
+    
+    Values land in logarithmically sized buckets, so any quantile is accurate
+    to within SKETCH_RELATIVE_ACCURACY of the true value while the sketch
+    stays a few hundred counters no matter how many calls are added.
+    """
+    
+    def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets: Counter = Counter()
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+    
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            self.buckets[math.ceil(math.log(value) / self.log_gamma)] += 1
+    
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        # Midpoint of the bucket (gamma^(i-1), gamma^i] in relative terms
+        return 2 * self.gamma ** index / (self.gamma + 1)
+    
+    def copy(self) -> "DurationSketch":
+        sketch = DurationSketch.__new__(DurationSketch)
+        sketch.__dict__.update(self.__dict__)
+        sketch.buckets = Counter(self.buckets)
+        return sketch
+    
+    def to_json(self) -> str:
+        return json.dumps({"zero": self.zero_count, "total": self.total, "buckets": self.buckets})
+    
+    @classmethod
+    def from_json(cls, value: str) -> "DurationSketch":
+        data = json.loads(value)
+        sketch = cls()
+        sketch.zero_count = data["zero"]
+        sketch.total = data["total"]
+        sketch.buckets = Counter({int(index): count for index, count in data["buckets"].items()})
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
+
+class CallAnalytics:
+    """Per-user and global usage rollups, kept in memory and in SQLite"""
+    
+    def __init__(self, filename: str = "analytics.db"):
+        self.filename = filename
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.daily: Dict[str, Dict[str, List[int]]] = {}
+        self.totals: Dict[str, List[int]] = {}
+        self.sketches: Dict[str, DurationSketch] = {}
+    
+    def start(self):
+        self.conn = open_local_db(self.filename)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS analytics_daily (
+                scope TEXT NOT NULL,
+                day TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                sms_sent INTEGER NOT NULL DEFAULT 0,
+                sms_failed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, day)
+            )
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS analytics_durations (scope TEXT PRIMARY KEY, sketch TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS analytics_events (event_id TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS analytics_meta (key TEXT PRIMARY KEY, value TEXT)")
+        
+        with self.lock:
+            for row in self.conn.execute(f"SELECT scope, day, {', '.join(ANALYTICS_COUNTERS)} FROM analytics_daily"):
+                scope, day, counts = row[0], row[1], list(row[2:])
+                self.daily.setdefault(scope, {})[day] = counts
+                totals = self.totals.setdefault(scope, [0] * len(ANALYTICS_COUNTERS))
+                for i, count in enumerate(counts):
+                    totals[i] += count
+            for scope, sketch in self.conn.execute("SELECT scope, sketch FROM analytics_durations"):
+                self.sketches[scope] = DurationSketch.from_json(sketch)
+            seeded = self.conn.execute("SELECT 1 FROM analytics_meta WHERE key = 'seeded'").fetchone()
+        
+        if not seeded:
+            threading.Thread(target=self.seed_from_history, name="analytics-seed", daemon=True).start()
+    
+    def _record(self, event_id: str, user_id: Optional[str], day: str, counts: Dict[str, int], duration: Optional[float] = None):
+        """Apply one event's counter increments (and duration) to the user's and the global rollups"""
+        if not self.conn:
+            return
+        scopes = [ANALYTICS_GLOBAL_SCOPE] + ([user_id] if user_id else [])
+        increments = [counts.get(name, 0) for name in ANALYTICS_COUNTERS]
+        
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.conn.execute("INSERT OR IGNORE INTO analytics_events (event_id) VALUES (?)", (event_id,)).rowcount == 0:
+                    self.conn.execute("ROLLBACK")
+                    return
+                
+                sketches = {}
+                for scope in scopes:
+                    self.conn.execute(
+                        f"""INSERT INTO analytics_daily (scope, day, {', '.join(ANALYTICS_COUNTERS)}) VALUES (?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (scope, day) DO UPDATE SET
+                            {', '.join(f'{name} = {name} + excluded.{name}' for name in ANALYTICS_COUNTERS)}""",
+                        (scope, day, *increments)
+                    )
+                    if duration is not None:
+                        sketch = self.sketches[scope].copy() if scope in self.sketches else DurationSketch()
+                        sketch.add(duration)
+                        self.conn.execute(
+                            "INSERT OR REPLACE INTO analytics_durations (scope, sketch) VALUES (?, ?)",
+                            (scope, sketch.to_json())
+                        )
+                        sketches[scope] = sketch
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            
+            # Only mirror into memory once the write is durable
+            for scope in scopes:
+                day_counts = self.daily.setdefault(scope, {}).setdefault(day, [0] * len(ANALYTICS_COUNTERS))
+                totals = self.totals.setdefault(scope, [0] * len(ANALYTICS_COUNTERS))
+                for i, increment in enumerate(increments):
+                    day_counts[i] += increment
+                    totals[i] += increment
+            self.sketches.update(sketches)
+    
+    def record_call_placed(self, call_id: str, user_id: Optional[str], day: Optional[str] = None):
+        self._record(f"call:{call_id}", user_id, day or analytics_day(), {"calls": 1})
+    
+    def record_call_failed(self, user_id: Optional[str]):
+        """A call Bland.ai refused to place - counted as placed and failed"""
+        self._record(f"call:failed:{uuid.uuid4()}", user_id, analytics_day(), {"calls": 1, "failed": 1})
+    
+    def record_call_outcome(self, call_id: str, user_id: Optional[str], succeeded: bool, duration: Optional[float], day: Optional[str] = None):
+        self._record(
+            f"outcome:{call_id}", user_id, day or analytics_day(),
+            {"completed": 1} if succeeded else {"failed": 1},
+            duration if succeeded else None
+        )
+    
+    def record_sms(self, sms_id: str, user_id: Optional[str], sent: bool, day: Optional[str] = None):
+        self._record(f"sms:{sms_id}", user_id, day or analytics_day(), {"sms_sent": 1} if sent else {"sms_failed": 1})
+    
+    def seed_from_history(self, page_size: int = 1000):
+        """Fold in calls and SMS recorded before analytics existed; already-counted events are skipped"""
+        try:
+            if supabase:
+                start = 0
+                while True:
+                    rows = supabase.table("call_history")\
+                        .select("call_id, user_id, call_time, status, call_duration")\
+                        .order("id")\
+                        .range(start, start + page_size - 1)\
+                        .execute().data or []
+                    for row in rows:
+                        if not row.get("call_id"):
+                            continue
+                        day = analytics_day(row.get("call_time"))
+                        self.record_call_placed(row["call_id"], row.get("user_id"), day)
+                        # Calls still pending (the schema default) have no outcome yet
+                        succeeded = call_succeeded(row.get("status"))
+                        if succeeded is not None:
+                            self.record_call_outcome(row["call_id"], row.get("user_id"), succeeded, row.get("call_duration"), day)
+                    if len(rows) < page_size:
+                        break
+                    start += page_size
+            
+            if sms_dispatcher.conn:
+                with sms_dispatcher.lock:
+                    messages = sms_dispatcher.conn.execute(
+                        "SELECT id, user_id, status, created_at FROM sms_history WHERE status IN ('sent', 'error')"
+                    ).fetchall()
+                for sms_id, user_id, status, created_at in messages:
+                    day = analytics_day(datetime.fromtimestamp(created_at).isoformat())
+                    self.record_sms(sms_id, user_id, status == "sent", day)
+            
+            with self.lock:
+                self.conn.execute("INSERT OR REPLACE INTO analytics_meta (key, value) VALUES ('seeded', ?)", (datetime.now().isoformat(),))
+            print("Call analytics seeded from existing history")
+        except Exception as e:
+            print(f"Error seeding call analytics: {str(e)}")
+    
+    def summary(self, scope: str, days: int) -> dict:
+        """Aggregates for one scope; cost depends on `days`, not on how many calls there were"""
+        with self.lock:
+            totals = dict(zip(ANALYTICS_COUNTERS, self.totals.get(scope, [0] * len(ANALYTICS_COUNTERS))))
+            daily = self.daily.get(scope, {})
+            today = datetime.now().date()
+            per_day = []
+            for offset in range(days - 1, -1, -1):
+                day = (today - timedelta(days=offset)).isoformat()
+                counts = daily.get(day)
+                if counts:
+                    per_day.append({"date": day, **dict(zip(ANALYTICS_COUNTERS, counts))})
+                else:
+                    per_day.append({"date": day, **{name: 0 for name in ANALYTICS_COUNTERS}})
+            sketch = self.sketches.get(scope)
+            durations = {"count": 0, "mean": None, "p50": None, "p90": None, "p99": None}
+            if sketch and sketch.count:
+                durations = {
+                    "count": sketch.count,
+                    "mean": round(sketch.total / sketch.count, 1),
+                    "p50": round(sketch.quantile(0.5), 1),
+                    "p90": round(sketch.quantile(0.9), 1),
+                    "p99": round(sketch.quantile(0.99), 1)
+                }
+        
+        finished = totals["completed"] + totals["failed"]
+        return {
+            "calls": totals["calls"],
+            "completed": totals["completed"],
+            "failed": totals["failed"],
+            "success_rate": round(totals["completed"] / finished, 4) if finished else None,
+            "duration_seconds": durations,
+            "sms": {"sent": totals["sms_sent"], "failed": totals["sms_failed"]},
+            "calls_per_day": per_day
+        }
+
+call_analytics = CallAnalytics()
+
+@app.on_event("startup")
+def start_call_analytics():
+    call_analytics.start()
+
+@app.get("/api/analytics")
+def get_analytics(user_id: Optional[str] = None, days: int = 30):
+    """Call and SMS usage for a user alongside the global totals.
+    
+    Success rate counts only calls that have finished; duration percentiles
+    are approximate (within 1%).
+    """
+    if days < 1 or days > ANALYTICS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"days must be between 1 and {ANALYTICS_MAX_DAYS}")
+    return {
+        "user": call_analytics.summary(user_id, days) if user_id else None,
+        "global": call_analytics.summary(ANALYTICS_GLOBAL_SCOPE, days)
+    }
 
 # IMPORTANT: Mount static files AFTER defining all API routes
 # Serve React static files only if the build directory exists (for production)
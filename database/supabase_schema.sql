@@ -106,7 +106,10 @@ CREATE TABLE IF NOT EXISTS call_transcript (
   id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
   call_id TEXT NOT NULL,
   user_id UUID REFERENCES auth.users(id) ON DELETE CASCADE,
+  -- Only set on older rows; newer rows derive the text from aligned_transcript
   transcript TEXT,
+  -- {"v": 2, "speakers": [...], "segments": [[speaker_index, text], ...]}
+  -- or {"v": 2, "z": "<base64 zlib of the same>"} for large transcripts
   aligned_transcript JSONB,
   recording_url TEXT,
   created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
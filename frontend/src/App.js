@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 // eslint-disable-next-line no-unused-vars
-import { triggerCall, getHistory, getCallTranscript, getCallDetails, getCallRecording } from './api';
+import { triggerCall, getHistory, getCallTranscript, getCallDetails, getCallRecording, getSmsStatus } from './api';
 import './themeToggle.css';
 import './App.css';
 import Auth from './components/Auth';
@@ -724,6 +724,21 @@ function App() {
     return () => window.removeEventListener('navigateToTab', handleNavigate);
   }, []);
 
+  const pollSmsDelivery = async (smsId) => {
+    for (let i = 0; i < 15; i++) {
+      await new Promise(resolve => setTimeout(resolve, 2000));
+      const sms = await getSmsStatus(smsId).catch(() => null);
+      if (sms && sms.status === 'sent') {
+        setStatus('SMS sent successfully!');
+        return;
+      }
+      if (sms && sms.status === 'error') {
+        setStatus('Failed to send SMS');
+        return;
+      }
+    }
+  };
+
   const handleSMS = async (e) => {
     e.preventDefault();
     if (!phone || !message) return;
@@ -771,6 +786,11 @@ function App() {
           });
         }
         setMessage(''); // Clear message after successful send
+        
+        // Queued messages are sent in the background - poll until delivery is known
+        if (response.status === 202 && data.id) {
+          pollSmsDelivery(data.id);
+        }
       } else {
         // Sanitize error messages to hide API provider details
         let errorMessage = 'Failed to send SMS';
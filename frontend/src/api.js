@@ -74,9 +74,14 @@ export async function getCallDetails(call_id) {
   }
 }
 
-export async function getCallTranscript(call_id) {
+// Pass the cursor from the previous response to get only new transcript segments
+function transcriptQuery(cursor) {
+  return cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+}
+
+export async function getCallTranscript(call_id, cursor) {
   try {
-    const res = await fetch(`${API_BASE}/call_transcript/${call_id}`);
+    const res = await fetch(`${API_BASE}/call_transcript/${call_id}${transcriptQuery(cursor)}`);
     if (!res.ok) throw new Error(await res.text());
     return res.json();
   } catch (error) {
@@ -85,16 +90,16 @@ export async function getCallTranscript(call_id) {
   }
 }
 
-export async function getCorrectedTranscript(call_id) {
+export async function getCorrectedTranscript(call_id, cursor) {
   try {
-    const res = await fetch(`${API_BASE}/call_corrected_transcript/${call_id}`);
+    const res = await fetch(`${API_BASE}/call_corrected_transcript/${call_id}${transcriptQuery(cursor)}`);
     if (!res.ok) throw new Error(await res.text());
     return res.json();
   } catch (error) {
     console.error("E006: Get Corrected Transcript Error");
     // Fall back to regular transcript if corrected isn't available
     try {
-      return await getCallTranscript(call_id);
+      return await getCallTranscript(call_id, cursor);
     } catch (fallbackError) {
       console.error("E007: Fallback Transcript Error");
       throw error; // Throw original error
@@ -112,3 +117,14 @@ export async function getCallRecording(call_id) {
     throw error;
   }
 }
+
+export async function getSmsStatus(sms_id) {
+  try {
+    const res = await fetch(`${API_BASE}/sms/${sms_id}`);
+    if (!res.ok) throw new Error(await res.text());
+    return res.json();
+  } catch (error) {
+    console.error("E010: Get SMS Status Error");
+    throw error;
+  }
+}
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { motion } from 'framer-motion';
 import { getCallDetails, getCallTranscript, getCorrectedTranscript, getCallRecording } from '../api';
 import { supabase } from '../supabaseClient';
@@ -15,9 +15,12 @@ const CallDetails = ({ callId, darkMode }) => {
   // Cache to avoid excessive API calls
   const [lastFetchTime, setLastFetchTime] = useState({});
   const [hasCompletedTranscript, setHasCompletedTranscript] = useState(false);
+  // Cursor from the last transcript response, so polls only fetch new segments
+  const transcriptCursor = useRef(null);
   
   useEffect(() => {
     let intervalId;
+    transcriptCursor.current = null;
     async function fetchCallData() {
       setError(null);
       try {
@@ -63,11 +66,16 @@ const CallDetails = ({ callId, darkMode }) => {
         if (!hasCompletedTranscript && 
             (needTranscriptFetch || !transcript || now - lastTranscriptTime > 3000)) {
           try {
-            const transcriptData = await getCorrectedTranscript(callId);
+            const transcriptData = await getCorrectedTranscript(callId, transcriptCursor.current);
             setLastFetchTime(prev => ({ ...prev, transcript: now }));
+            const isDelta = transcriptCursor.current && transcriptData && transcriptData.reset === false;
+            if (transcriptData && transcriptData.cursor) {
+              transcriptCursor.current = transcriptData.cursor;
+            }
             
             if (transcriptData && transcriptData.status === "success" && transcriptData.aligned) {
-              setTranscript(transcriptData.aligned);
+              // Append new segments to what we have, unless the server asked us to start over
+              setTranscript(prev => (isDelta ? [...(prev || []), ...transcriptData.aligned] : transcriptData.aligned));
               // If we have aligned transcript and call is complete, stop polling
               if (detailsData && (detailsData.status === 'success' || detailsData.status === 'completed')) {
                 setHasCompletedTranscript(true);